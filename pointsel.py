@@ -9,11 +9,12 @@
 from __future__ import division, print_function
 from numpy import array
 import numpy as np
-from scipy.optimize import bisect
-import sys, os, math
+import sys, os, math, time
 
 import wx
 
+import selengine
+
 import matplotlib
 
 matplotlib.use('WXAgg')
@@ -25,6 +26,7 @@ from matplotlib.backends.backend_wx import _load_bitmap, StatusBarWx
 from matplotlib.figure import Figure
 from matplotlib.widgets import RectangleSelector
 from matplotlib.patches import Rectangle
+from matplotlib.image import AxesImage
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 from matplotlib import rcParams
@@ -34,6 +36,49 @@ version = "1.0.8"
 
 rcParams['savefig.format']='tif'
 
+# Data sets with more points are culled to the view and decimated
+# to the screen resolution before drawing (see cullView).
+CULL_MIN=1<<18
+# Margin fetched around the view (in view sizes) and the number
+# of culled views kept in the cache.
+CULL_MARGIN=0.5
+CULL_CACHE=16
+# Data sets with more points show estimates from a sample of
+# SAMPLE_SIZE points while the ROI is dragged.
+PROGRESSIVE_MIN=1<<20
+SAMPLE_SIZE=1<<18
+
+
+class ColumnBuffer(object):
+    '''
+    Growable storage for the data array (columns x points).
+    The capacity is doubled when exhausted, so appending rows
+    costs amortized constant time per point. The data property
+    returns a view of the filled part of the buffer.
+    '''
+    def __init__(self, d, capacity=1024):
+        self.n=d.shape[1]
+        self.buf=np.empty((d.shape[0], max(self.n, capacity)), dtype=d.dtype)
+        self.buf[:,:self.n]=d
+
+    @property
+    def data(self):
+        return self.buf[:,:self.n]
+
+    def append(self, d):
+        if d.shape[0]!=self.buf.shape[0] :
+            raise ValueError('Expected %d columns, got %d'
+                                % (self.buf.shape[0], d.shape[0]))
+        k=d.shape[1]
+        if self.n+k > self.buf.shape[1] :
+            nb=np.empty((self.buf.shape[0], max(2*self.buf.shape[1], self.n+k)),
+                        dtype=self.buf.dtype)
+            nb[:,:self.n]=self.buf[:,:self.n]
+            self.buf=nb
+        self.buf[:,self.n:self.n+k]=d
+        self.n+=k
+
+
 class RectSelector(RectangleSelector):
     '''
     Works only in data coordinates!
@@ -127,6 +172,8 @@ class RectSelector(RectangleSelector):
     def release(self, ev):
         if self.eventpress is None or self.ignore(ev):
             return
+        # Too small selections are rejected without calling onselect
+        self.ax.figure.canvas.parentFrame.cancelPreview()
         if self.fixedSize and self.prevEvents:
             # Panning mode. Modify the existing ROI. Do the shift.
             self.eventpress.xdata=ev.xdata
@@ -152,6 +199,12 @@ class RectSelector(RectangleSelector):
             ev.xdata+=self.wdata
             ev.ydata+=self.hdata
         RectangleSelector.onmove(self, ev)
+        pe=self.eventpress
+        if ev.xdata is None or pe is None :
+            return
+        self.ax.figure.canvas.parentFrame.previewROI(
+                    min(pe.xdata, ev.xdata), max(pe.xdata, ev.xdata),
+                    min(pe.ydata, ev.ydata), max(pe.ydata, ev.ydata))
 
 
 class CustomToolbar(NavToolbar):
@@ -238,6 +291,15 @@ class CustomToolbar(NavToolbar):
         if wx.Platform == '__WXMAC__':
             self.to_draw.set_visible(False)
         NavToolbar.release_zoom(self,ev)
+        self._set_markers()
+
+    def drag_pan(self, ev):
+        NavToolbar.drag_pan(self,ev)
+        self._set_markers()
+
+    def release_pan(self, ev):
+        NavToolbar.release_pan(self,ev)
+        self._set_markers()
 
     def draw_rubberband(self, event, x0, y0, x1, y1):
         # XOR does not work on MacOS ...
@@ -375,8 +437,30 @@ class CanvasFrame(wx.Frame):
         filemenu= wx.Menu()
         menuOpen = filemenu.Append(wx.ID_OPEN,
                     "&Open\tCTRL+O"," Open a data file")
+        self.menuWatch = filemenu.AppendCheckItem(wx.ID_ANY,
+                    "&Watch file\tCTRL+W"," Follow rows appended to the data file")
+        self.menuCompact = filemenu.AppendCheckItem(wx.ID_ANY,
+                    "&Compact storage"," Keep the data as 32-bit floats")
+        self.menuDedup = filemenu.AppendCheckItem(wx.ID_ANY,
+                    "Merge d&uplicates"," Merge the points closer than a tolerance when reading")
+        menuChannel = filemenu.Append(wx.ID_ANY,
+                    "Add c&hannel\tCTRL+H"," Add values from a file with the same points")
+        menuSaveSession = filemenu.Append(wx.ID_ANY,
+                    "&Save session\tCTRL+S"," Save the data, ROI and view for later")
+        menuOpenSession = filemenu.Append(wx.ID_ANY,
+                    "Open sess&ion\tCTRL+I"," Restore a saved session")
+        self.menuSizeMap = filemenu.AppendCheckItem(wx.ID_ANY,
+                    "Size &map\tCTRL+M"," Show the width of the square with n points over the map")
+        menuExportMap = filemenu.Append(wx.ID_ANY,
+                    "Export size ma&p"," Export the size map to a CSV file")
+        self.menuRaster = filemenu.AppendCheckItem(wx.ID_ANY,
+                    "&Raster drawing\tCTRL+R"," Draw the points as an image of pixels")
+        self.menuDensity = filemenu.AppendCheckItem(wx.ID_ANY,
+                    "&Density colours"," Colour the raster by the number of points")
         menuExport = filemenu.Append(wx.ID_SAVE,
                     "&Export selection\tCTRL+E"," Export selected data to a file.")
+        menuTiles = filemenu.Append(wx.ID_ANY,
+                    "Export &tiles"," Cut the data into tiles and export each of them")
         menuAbout= filemenu.Append(wx.ID_ABOUT,
                     "About"," Information about this program")
         menuExit = filemenu.Append(wx.ID_EXIT,
@@ -391,12 +475,24 @@ class CanvasFrame(wx.Frame):
 
         # Events.
         self.Bind(wx.EVT_MENU, self.onOpen, menuOpen)
+        self.Bind(wx.EVT_MENU, self.onWatch, self.menuWatch)
+        self.Bind(wx.EVT_MENU, self.onDedup, self.menuDedup)
+        self.Bind(wx.EVT_MENU, self.onAddChannel, menuChannel)
+        self.Bind(wx.EVT_MENU, self.onSaveSession, menuSaveSession)
+        self.Bind(wx.EVT_MENU, self.onOpenSession, menuOpenSession)
+        self.Bind(wx.EVT_MENU, self.onSizeMap, self.menuSizeMap)
+        self.Bind(wx.EVT_MENU, self.onExportSizeMap, menuExportMap)
+        self.Bind(wx.EVT_MENU, self.onRaster, self.menuRaster)
+        self.Bind(wx.EVT_MENU, self.onRaster, self.menuDensity)
         self.Bind(wx.EVT_MENU, self.onExport, menuExport)
+        self.Bind(wx.EVT_MENU, self.onExportTiles, menuTiles)
         self.Bind(wx.EVT_MENU, self.onExit, menuExit)
         self.Bind(wx.EVT_MENU, self.onAbout, menuAbout)
 
         self.numSelected = 0
         self.conc = 0
+        # Sums of the selected values in the columns given by sumColumns
+        self.selSums = np.zeros(1)
         self.targetSelected = 0
         self.numPoints = 0
         self.figure = Figure(figsize=(10,10))
@@ -406,6 +502,52 @@ class CanvasFrame(wx.Frame):
 
         self.datfn=''
         self.dat=[['',''],array([[],[]])]
+        # Data = flip*raw - offset, needed to transform appended rows
+        self.flip=[1,1]
+        self.offset=[0,0]
+        # Coordinate and value columns of the data
+        self.cols=[0,1]
+        self.valCol=2
+        # Column projection and storage type of the loaded data
+        self.readCols=None
+        self.readDtype=float
+        # Merging of the duplicated points: tolerance, mode
+        # and the number of points removed from the data
+        self.dedupParams=(0.001, 'mean')
+        self.dedupRemoved=0
+        # Fingerprints of the data and channel files
+        self.datFingerprint=None
+        self.channelFiles=[]
+        # Arrays derived from the data, stored in sessions.
+        # Dropped whenever the data changes.
+        self.derived={}
+        # Streaming statistics of the points in statsBox
+        self.roiStats=None
+        self.statsBox=None
+        self.statsCols=None
+        # KD-tree of the coordinates, the size map (n, x, y, w, count)
+        # and its image over the plot
+        self.kdTree=None
+        self.sizeMap=None
+        self.sizeImg=None
+        # Culled views of the plot: (level, l,r,b,t box, x, y)
+        self.viewCache=[]
+        # Image replacing the plot in the raster drawing mode
+        self.rasterImg=None
+        self.densityLUT=(mpl.cm.viridis(np.linspace(0, 1, 256))*255).astype(np.uint8)
+        # Jittered ROIs: number, shift and resize fractions
+        self.jitterParams=(200, 0.1, 0.0)
+        # Exact count of the dragged ROI after the pointer rests
+        self.previewLater=None
+
+        # Live-tail state
+        self.tailBuf=None
+        self.tailPos=0
+        self.tailDirty=False
+        self.tailLastDraw=0
+        self.tailRedrawInterval=2.0
+        self.tailTimer=wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.onTailTimer, self.tailTimer)
         self.dirname, self.filename= os.path.split(self.datfn)
 
         self.plot,=self.axes.plot([],[],',')
@@ -446,6 +588,32 @@ class CanvasFrame(wx.Frame):
         self.concDSP = wx.StaticText(self.ctrlPanel, style=wx.ALIGN_LEFT)
         self.sideBar.Add(self.concDSP, 0, wx.BOTTOM | wx.LEFT)
         self.sideBar.AddSpacer(3)
+        self.chanDSP = wx.StaticText(self.ctrlPanel, style=wx.ALIGN_LEFT)
+        self.sideBar.Add(self.chanDSP, 0, wx.BOTTOM | wx.LEFT)
+        self.sideBar.AddSpacer(3)
+        self.sideBar.Add(wx.StaticLine(self.ctrlPanel,size=(100,-1)), 0, wx.BOTTOM | wx.CENTER)
+
+        # Statistics panel
+        self.sideBar.AddSpacer(3)
+        self.statsCB = wx.CheckBox(self.ctrlPanel, label='Statistics', style=wx.ALIGN_LEFT)
+        self.sideBar.Add(self.statsCB, 0, wx.LEFT)
+        self.statsDSP = wx.StaticText(self.ctrlPanel, style=wx.ALIGN_LEFT)
+        self.sideBar.Add(self.statsDSP, 0, wx.BOTTOM | wx.LEFT)
+        self.histFigure = Figure(figsize=(2,1.2))
+        self.histAxes = self.histFigure.add_axes([0.04,0.22,0.92,0.76])
+        self.histAxes.tick_params(labelsize=7, left=False, labelleft=False)
+        self.histPlot, = self.histAxes.plot([],[], drawstyle='steps-post')
+        self.histCanvas = FigureCanvas(self.ctrlPanel, -1, self.histFigure)
+        self.sideBar.Add(self.histCanvas, 0, wx.LEFT)
+        self.histCanvas.Hide()
+        self.sideBar.Add(wx.StaticLine(self.ctrlPanel,size=(100,-1)), 0, wx.BOTTOM | wx.CENTER)
+
+        # Spread of the concentration over jittered ROIs
+        self.sideBar.AddSpacer(3)
+        self.jitterCB = wx.CheckBox(self.ctrlPanel, label='Jitter', style=wx.ALIGN_LEFT)
+        self.sideBar.Add(self.jitterCB, 0, wx.LEFT)
+        self.jitterDSP = wx.StaticText(self.ctrlPanel, style=wx.ALIGN_LEFT)
+        self.sideBar.Add(self.jitterDSP, 0, wx.BOTTOM | wx.LEFT)
         self.sideBar.Add(wx.StaticLine(self.ctrlPanel,size=(100,-1)), 0, wx.BOTTOM | wx.CENTER)
 
         self.sideBar.AddSpacer(9)
@@ -498,6 +666,19 @@ class CanvasFrame(wx.Frame):
         for i in [1,3,5,7] : self.anchorRB.ShowItem(i,False)
         self.sideBar.Add(self.anchorRB, 0, wx.BOTTOM | wx.LEFT | wx.EXPAND)
 
+        self.sideBar.AddSpacer(9)
+        # Column switches
+        box = wx.StaticBoxSizer(wx.StaticBox(self.ctrlPanel, label='Columns:'),wx.VERTICAL)
+        self.colChoices=[]
+        for lbl in ['X:', 'Y:', 'V:'] :
+            hbox = wx.BoxSizer(wx.HORIZONTAL)
+            ch=wx.Choice(self.ctrlPanel, size=(100,-1))
+            hbox.Add(wx.StaticText(self.ctrlPanel, label=lbl, style=wx.ALIGN_RIGHT), 0, wx.CENTER)
+            hbox.Add(ch, 1, wx.LEFT | wx.EXPAND)
+            box.Add(hbox, 0, wx.TOP | wx.LEFT | wx.EXPAND)
+            self.colChoices.append(ch)
+        self.sideBar.Add(box, 0, wx.LEFT | wx.EXPAND)
+
         self.sideBar.AddSpacer(9)
         # Flip buttons
         box = wx.StaticBoxSizer(wx.StaticBox(self.ctrlPanel, label='Flip data:'),wx.HORIZONTAL)
@@ -549,6 +730,10 @@ class CanvasFrame(wx.Frame):
         self.flipXBTN.Bind(wx.EVT_BUTTON, self.onFlipX)
         self.flipYBTN.Bind(wx.EVT_BUTTON, self.onFlipY)
         self.aspectRB.Bind(wx.EVT_RADIOBOX, self.onAspectChange)
+        for ch in self.colChoices :
+            ch.Bind(wx.EVT_CHOICE, self.onColumnsChange)
+        self.statsCB.Bind(wx.EVT_CHECKBOX, self.onStats)
+        self.jitterCB.Bind(wx.EVT_CHECKBOX, self.onJitter)
 
         if self.toolbar is not None:
             self.toolbar.Realize()
@@ -577,6 +762,7 @@ class CanvasFrame(wx.Frame):
         try :
             self.dirname, self.filename=os.path.split(self.datfn)
             self.dat=self.readData(self.datfn)
+            self.setColumnChoices()
             self.displayData(self.dat[1],self.dat[0])
             self.axes.set_title(self.filename)
         except IOError :
@@ -599,7 +785,7 @@ class CanvasFrame(wx.Frame):
         toolbar.set_status_bar(statbar)
         return toolbar
 
-    def readData(self, fn, skip=1):
+    def readData(self, fn, skip=1, cols=None, dtype=float):
         '''
         Read and translate the data from the file named fn.
         The data is returned as an array of rows x cols
@@ -608,63 +794,137 @@ class CanvasFrame(wx.Frame):
         If the skip is >0 the contents of this line is returned
         in the first member of the returned list as a list
         of labels (split on ;).
+        Only the file columns listed in cols (default: all) are
+        loaded and stored as dtype numbers.
+        '''
+        # Parse first, the frame state changes only if the read succeeds.
+        fp=selengine.fingerprint(fn)
+        size=os.path.getsize(fn)
+        if size>=selengine.PARALLEL_MIN :
+            # Large file. Parse it on all cores.
+            # An unfinished last line is left for the live-tail mode.
+            pos=selengine.last_line(fn, size)[0]
+            r=selengine.read_data_parallel(fn, skip, cols, dtype, end=pos)
+        else :
+            r, pos = self.readSerial(fn, skip, cols, dtype)
+        removed=0
+        if self.menuDedup.IsChecked() and not self.menuWatch.IsChecked() :
+            r[1], removed = selengine.dedup(r[1], *self.dedupParams)
+        self.readCols=cols
+        self.readDtype=dtype
+        self.datFingerprint=fp
+        self.channelFiles=[]
+        self.tailPos=pos
+        self.dedupRemoved=removed
+        d=r[1]
+        #print(d, d.shape)
+        self.flip=[1,1]
+        self.offset=[0,0]
+        self.cols=[0,1]
+        self.valCol=2
+        self._shift_to_origin(d)
+        return r
+
+    def readSerial(self, fn, skip=1, cols=None, dtype=float):
         '''
-        df=open(fn).readlines()
+        Serial part of readData for small files.
+        Returns the [labels, data] list and the offset where
+        the complete lines end.
+        '''
+        with open(fn, newline='\n') as f :
+            df=f.readlines()
+            # Remember where the data ends for the live-tail mode.
+            pos=f.tell()
+        if df and not df[-1].endswith('\n') :
+            # The last line may still be written. Leave it
+            # to be read when following the file.
+            pos-=len(df.pop().encode(f.encoding))
         #print(df)
         #print(df[0].strip())
-        # The translation replaces ; and , by space and dot.
         if skip>0 :
             lbl=df[0].replace('#','').strip().split(';')
+            if cols is not None :
+                lbl=[lbl[i] if i<len(lbl) else '' for i in cols]
         else :
             lbl=None
-        r = [lbl, array([[float(v)
-                            for v in  ln.replace(';',' ').replace(',','.').split()]
-                                for ln in df[skip:] if ln[0]!='#' and ln.split()]).T]
-        d=r[1]
-        #print(d, d.shape)
-        self._shift_to_origin(d)
-        return r
+        return [lbl, selengine.parse_lines(df[skip:], cols, dtype)], pos
 
-    def getSelected(self, lrbt=None):
+    def parseLines(self, lines):
         '''
-        Return an array of points inside the lrbt bounding box.
+        Translate data lines into an array of cols x rows.
+        Comment (#) and empty lines are skipped.
+        '''
+        return selengine.parse_lines(lines, self.readCols, self.readDtype)
+
+    def readTail(self):
+        '''
+        Parse the complete lines appended to the data file since
+        the last read. Returns an array of cols x rows or None.
+        '''
+        with open(self.datfn, 'rb') as f :
+            f.seek(self.tailPos)
+            chunk=f.read()
+        # Only complete lines. The rest is read next time.
+        cut=chunk.rfind(b'\n')+1
+        if cut==0 :
+            return None
+        self.tailPos+=cut
+        lines=chunk[:cut].decode(errors='replace').split('\n')
+        d=self.parseLines(lines)
+        if d.size==0 :
+            return None
+        return d
+
+    def getROIbox(self, lrbt=None):
+        '''
+        Return l,r,b,t of the ROI or of the lrbt bounding box.
+        Raises AttributeError if there is no ROI.
         '''
         if lrbt is None :
-            try :
-                l,b,r,t=array(self.toolbar.roi.get_bbox()).reshape(4)
-            except AttributeError :
-                return None
+            l,b,r,t=array(self.toolbar.roi.get_bbox()).reshape(4)
         else :
             # The bbox is expected as l,r,b,t tuple!
             l,r,b,t=array(lrbt).reshape(4)
+        return l,r,b,t
+
+    def getSelected(self, lrbt=None):
+        '''
+        Return an array of points inside the lrbt bounding box.
+        '''
+        try :
+            l,r,b,t=self.getROIbox(lrbt)
+        except AttributeError :
+            return None
         #print('LTRB:', l,t,r,b)
-        d=self.dat[1]
-        sel=d[...,(l<d[0]) & (d[0]<r) & (b<d[1]) & (d[1]<t)]
-        return sel
+        return selengine.select_box(self.dat[1], l, r, b, t, self.cols)
+
+    def countSelected(self, lrbt=None):
+        '''
+        Return the number and the sums of values (in sumColumns) of
+        the points inside the lrbt bounding box without selecting them.
+        '''
+        return selengine.count_sum_box(self.dat[1], *self.getROIbox(lrbt),
+                                        col=self.sumColumns(), xy=self.cols)
+
+    def sumColumns(self):
+        '''
+        Return the value column followed by the other channel columns.
+        '''
+        return [self.valCol]+[c for c in range(self.dat[1].shape[0])
+                                if c not in self.cols and c!=self.valCol]
 
     def exportData(self, fn):
-        hdr=' ;'.join([' %s' % s.strip() for s in self.dat[0]])
         sel=self.getSelected()
-        try :
-            x, y = self.toolbar.roi.get_xy()
-            w = self.toolbar.roi.get_width()
-            h = self.toolbar.roi.get_height()
-            hdr += '\n'
-            hdr += (' ROI (um): X=%.2f  Y=%.2f  W=%.2f  H=%.2f    Points=%d   Concentration=%g'
-                        % (x, y, w,h, sel.shape[1],sum(sel[2])/(w*h)) )
-        except AttributeError :
-            # No roi
-            pass
         if sel is None :
             wx.MessageBox('Nothing to save yet. Make some selection before trying to export data.',
                             'Nothing to export!')
-        else :
-            d=array(sel)
-            # Shift exported data to the origin
-            d[0]-=min(d[0])
-            d[1]-=min(d[1])
-            np.savetxt(fn, d.T, fmt='%11.3f', delimiter=' ', newline='\n',
-                header=hdr, footer='', comments='#')
+            return
+        x, y = self.toolbar.roi.get_xy()
+        w = self.toolbar.roi.get_width()
+        h = self.toolbar.roi.get_height()
+        hdr=selengine.roi_header(self.dat[0], sel, x, y, w, h, self.valCol,
+                                    self.sumColumns(), self.jitterSpread())
+        selengine.write_selection(fn, sel, hdr, self.cols)
 
 
     def setLimits(self):
@@ -681,11 +941,27 @@ class CanvasFrame(wx.Frame):
     def showWH(self, w=0, h=0):
         self.whDSP.SetLabel('Size (um):  \n W: %-8g\n H: %-8g' % (w, h))
 
-    def showNumber(self, n=0):
-        self.numberDSP.SetLabel('Selected pnts: \n %-d' % (n))
+    def showNumber(self, n=0, dn=None):
+        if dn is None :
+            self.numberDSP.SetLabel('Selected pnts: \n %-d' % (n))
+        else :
+            self.numberDSP.SetLabel('Selected pnts: \n ~%d +/- %d' % (n, dn))
+
+    def showConc(self, g=0, dg=None):
+        if dg is None :
+            self.concDSP.SetLabel('Concentration: \n %.3f' % (g))
+        else :
+            self.concDSP.SetLabel('Concentration: \n ~%.3f +/- %.3f' % (g, dg))
 
-    def showConc(self, g=0):
-        self.concDSP.SetLabel('Concentration: \n %.3f' % (g))
+    def showChannels(self, g=()):
+        if len(g)<2 :
+            self.chanDSP.SetLabel('')
+            return
+        lbl=self.dat[0]
+        self.chanDSP.SetLabel('Channels: \n' +
+                    '\n'.join([' %s: %.3f' % (lbl[c].strip() if c<len(lbl) else c, v)
+                                for c, v in zip(self.sumColumns(), g)]))
+        self.ctrlPanel.FitInside()
 
     def showROI(self, x, y, w, h):
         self.showLTRB(l=x,t=y+h,r=x+w,b=y)
@@ -693,21 +969,185 @@ class CanvasFrame(wx.Frame):
         self.showWH(w,h)
 
     def setWH(self, w, h):
+        if self.previewLater is not None :
+            self.previewLater.Stop()
         self.widthCtrl.SetValue(w)
         self.heightCtrl.SetValue(h)
         self.showArea(w*h)
         self.showWH(w,h)
         try :
-            sel=self.getSelected()
-            self.numSelected=sel.shape[1]
-            self.conc=sum(sel[2])/(w*h)
+            self.numSelected, self.selSums = self.countSelected()
+            self.conc=self.selSums[0]/(w*h)
         except AttributeError :
             self.numSelected=0
+            self.selSums=np.zeros(1)
             self.conc=0.0
         if not self.fixedNumberCB.IsChecked() :
             self.numPtsCtrl.SetValue(self.numSelected)
         self.showNumber(self.numSelected)
         self.showConc(self.conc)
+        self.showChannels(self.selSums/(w*h))
+        self.updateStats()
+        self.updateJitter()
+
+    def getSample(self):
+        '''
+        Return the stratified sample of the large data (kept with the
+        derived arrays) or None if the data is counted fast enough.
+        '''
+        d=self.dat[1]
+        if d.shape[1]<PROGRESSIVE_MIN or self.tailBuf is not None :
+            return None
+        if 'sample' not in self.derived :
+            self.derived['sample']=d[:,selengine.stratified_sample(d,
+                            (self.minX, self.maxX, self.minY, self.maxY),
+                            SAMPLE_SIZE, self.cols)]
+        return self.derived['sample']
+
+    def previewROI(self, l, r, b, t):
+        '''
+        Show the number and concentration of the ROI being dragged.
+        For large data these are estimated from the sample, with
+        the 95% confidence intervals, and counted exactly when
+        the pointer rests for a moment.
+        '''
+        a=(r-l)*(t-b)
+        if a<=0 or not self.numPoints :
+            return
+        s=self.getSample()
+        if s is None :
+            self.previewExact(l, r, b, t)
+            return
+        n, v, dn, dv = selengine.estimate_box(s, s.shape[1]/self.dat[1].shape[1],
+                                        l, r, b, t, self.valCol, self.cols)
+        self.showNumber(n, dn)
+        self.showConc(v/a, dv/a)
+        if self.previewLater is None :
+            self.previewLater=wx.CallLater(300, self.previewExact, l, r, b, t)
+        else :
+            self.previewLater.Restart(300, l, r, b, t)
+
+    def cancelPreview(self):
+        '''
+        Stop the pending exact count of the dragged ROI
+        and show the values of the current ROI again.
+        '''
+        if self.previewLater is not None :
+            self.previewLater.Stop()
+        self.showNumber(self.numSelected)
+        self.showConc(self.conc)
+
+    def previewExact(self, l, r, b, t):
+        n, v = selengine.count_sum_box(self.dat[1], l, r, b, t,
+                                        self.valCol, self.cols)
+        self.showNumber(n)
+        self.showConc(v/((r-l)*(t-b)))
+
+    def onStats(self, ev):
+        self.histCanvas.Show(self.statsCB.IsChecked())
+        self.roiStats=None
+        if self.statsCB.IsChecked() :
+            self.updateStats()
+        else :
+            self.statsDSP.SetLabel('')
+        self.ctrlPanel.Layout()
+        self.ctrlPanel.FitInside()
+
+    def updateStats(self):
+        '''
+        Update the statistics of the values in the ROI. Only the points
+        which entered or left the ROI since the last update are scanned.
+        '''
+        if not self.statsCB.IsChecked() :
+            return
+        try :
+            box=self.getROIbox()
+        except AttributeError :
+            return
+        cols=self.sumColumns()
+        if self.roiStats is None or self.statsCols!=cols :
+            if 'colRange' not in self.derived :
+                d=self.dat[1]
+                self.derived['colRange']=np.array([d.min(axis=1), d.max(axis=1)])
+            lo, hi = self.derived['colRange'][:,cols]
+            self.roiStats=selengine.StreamStats(lo, hi)
+            self.statsCols=cols
+            self.statsBox=None
+        selengine.update_stats(self.roiStats, self.dat[1], self.statsBox, box,
+                                cols, self.cols)
+        self.statsBox=box
+        self.showStats()
+
+    def onJitter(self, ev):
+        '''Ask for the jitter parameters and show the spread'''
+        if self.jitterCB.IsChecked() :
+            dlg=wx.TextEntryDialog(self, 'Number of boxes, shift and resize '
+                                    '(fractions of the ROI size):',
+                                    'Jitter', '%d, %g, %g' % self.jitterParams)
+            try :
+                if dlg.ShowModal() != wx.ID_OK :
+                    self.jitterCB.SetValue(False)
+                    return
+                k, shift, resize = dlg.GetValue().split(',')
+                k, shift, resize = int(k), float(shift), float(resize)
+                if k<2 or shift<0 or not 0<=resize<1 :
+                    raise ValueError
+            except ValueError :
+                wx.MessageBox('Give the number of boxes (at least 2), the shift '
+                                'and the resize (below 1) separated by commas.',
+                                'Wrong jitter parameters!')
+                self.jitterCB.SetValue(False)
+                return
+            finally :
+                dlg.Destroy()
+            self.jitterParams=(k, shift, resize)
+        self.updateJitter()
+        self.ctrlPanel.Layout()
+        self.ctrlPanel.FitInside()
+
+    def jitterSpread(self):
+        '''
+        Return the summary of the concentration over the jittered
+        copies of the ROI or None if not enabled.
+        '''
+        if not self.jitterCB.IsChecked() or self.toolbar.roi is None :
+            return None
+        x, y = self.toolbar.roi.get_xy()
+        w = self.toolbar.roi.get_width()
+        h = self.toolbar.roi.get_height()
+        if w*h<=0 :
+            return None
+        k, shift, resize = self.jitterParams
+        return selengine.spread_summary(selengine.jitter_concentration(
+                        self.dat[1], x, y, w, h, k, shift, resize,
+                        self.valCol, self.cols))
+
+    def updateJitter(self):
+        sp=self.jitterSpread()
+        if sp is None :
+            self.jitterDSP.SetLabel('')
+            return
+        self.jitterDSP.SetLabel(' Boxes: %d\n Mean: %-8.4g\n Std:  %-8.4g\n'
+                                ' P5/50/95:\n  %.4g %.4g %.4g' % sp)
+
+    def showStats(self):
+        st=self.roiStats
+        lbl=self.dat[0]
+        names=[lbl[c].strip() if c<len(lbl) else str(c) for c in self.statsCols]
+        std=np.sqrt(st.var())
+        q=st.quantiles(0, [0.05, 0.25, 0.5, 0.75, 0.95])
+        txt=(' %s\n N: %d\n Mean: %-8.4g\n Std:  %-8.4g\n'
+                % (names[0], st.n, st.mean[0], std[0]))
+        txt+=' Q5/25/50/75/95:\n  %.4g %.4g %.4g\n  %.4g %.4g' % tuple(q)
+        for i in range(1, len(names)) :
+            txt+='\n %s: %.4g +- %.4g' % (names[i], st.mean[i], std[i])
+        self.statsDSP.SetLabel(txt)
+        e=st.edges(0)
+        self.histPlot.set_data(e, np.append(st.hist[0], st.hist[0][-1]))
+        self.histAxes.set_xlim(e[0], e[-1])
+        self.histAxes.set_ylim(0, max(1, st.hist[0].max())*1.05)
+        self.histCanvas.draw_idle()
+        self.ctrlPanel.FitInside()
 
     def displayData(self, dat, lbl=None, cols=(0,1)):
         '''
@@ -725,15 +1165,125 @@ class CanvasFrame(wx.Frame):
         #self.axes.legend((self.filename,))
 
     def set_markers(self):
-        sel=self.getSelected(self.axes.get_xlim()+self.axes.get_ylim())
-        if sel.shape[1] < 5000 :
+        '''
+        Choose the marker by the number of points in the view.
+        Large data sets are culled to the view first.
+        '''
+        lrbt=self.getROIbox(self.axes.get_xlim()+self.axes.get_ylim())
+        if self.menuRaster.IsChecked() :
+            self.rasterView(*lrbt)
+            return
+        if self.dat[1].shape[1]<CULL_MIN or self.tailBuf is not None :
+            n=selengine.count_box(self.dat[1], *lrbt, xy=self.cols)
+        else :
+            n=self.cullView(*lrbt)
+        if n < 5000 :
             self.plot.set_marker('o')
         else :
             self.plot.set_marker(',')
 
 
+    def cullView(self, l, r, b, t):
+        '''
+        Feed the plot with the points of the l,r,b,t view taken from
+        the coarsest decimation level with cells smaller than a pixel
+        (or from all points when zoomed in). The points are fetched with
+        a margin and cached, so small pans and returns to the views of
+        the zoom stack need no refetch. Returns the number of the drawn
+        points inside the view.
+        '''
+        d=self.dat[1]
+        if 'cull_all' not in self.derived :
+            for k, idx in selengine.decimate(d,
+                        (self.minX, self.maxX, self.minY, self.maxY),
+                        self.cols).items() :
+                self.derived['cull_%s' % k]=idx
+        levels=[int(k[5:]) for k in self.derived
+                    if k.startswith('cull_') and k!='cull_all']
+        px=(r-l)/max(self.axes.bbox.width, 1)
+        py=(t-b)/max(self.axes.bbox.height, 1)
+        k=int(math.ceil(math.log(max(self.maxX/px, self.maxY/py, 1), 2)))
+        if levels :
+            k=max(k, min(levels))
+        lvl='cull_%d' % k if k in levels else 'cull_all'
+        for i, (lv, box, xs, ys) in enumerate(self.viewCache) :
+            if lv==lvl and box[0]<=l and r<=box[1] and box[2]<=b and t<=box[3] :
+                self.viewCache.append(self.viewCache.pop(i))
+                break
+        else :
+            mw, mh = CULL_MARGIN*(r-l), CULL_MARGIN*(t-b)
+            box=(l-mw, r+mw, b-mh, t+mh)
+            x, y = d[self.cols[0]], d[self.cols[1]]
+            idx=selengine.cull_index(x, y, self.derived[lvl], *box)
+            xs, ys = x[idx], y[idx]
+            self.viewCache=self.viewCache[1-CULL_CACHE:]+[(lvl, box, xs, ys)]
+        self.plot.set_data(xs, ys)
+        return np.count_nonzero((l<xs) & (xs<r) & (b<ys) & (ys<t))
+
+    def rasterView(self, l, r, b, t):
+        '''
+        Draw the points of the l,r,b,t view as an image with one pixel
+        per screen pixel instead of the plot markers. The image covers
+        the axes rounded out to whole pixels and the points are mapped
+        with the transData transform, so it is aligned with the ROI.
+        With few points in the view the pixels are grown to markers.
+        '''
+        d=self.dat[1]
+        x, y = d[self.cols[0]], d[self.cols[1]]
+        if 'cull_all' in self.derived :
+            idx=selengine.cull_index(x, y, self.derived['cull_all'], l, r, b, t)
+            if len(idx)<len(x)//2 :
+                x, y = x[idx], y[idx]
+        bb=self.axes.bbox
+        x0, y0 = math.floor(bb.x0), math.floor(bb.y0)
+        w, h = int(math.ceil(bb.x1))-x0, int(math.ceil(bb.y1))-y0
+        m=self.axes.transData.get_affine().get_matrix().copy()
+        m[0,2]-=x0
+        m[1,2]-=y0
+        cnt=selengine.rasterize(x, y, m, w, h)
+        if cnt.sum()<5000 :
+            cnt=selengine.dilate(cnt, rcParams['lines.markersize']/2*self.figure.dpi/72)
+        if self.menuDensity.IsChecked() :
+            v=np.log1p(cnt)
+            rgba=self.densityLUT[(v*(255/max(v.max(), 1))).astype(np.uint8)]
+            rgba[cnt==0]=0
+        else :
+            rgba=np.zeros((h, w, 4), dtype=np.uint8)
+            rgba[cnt>0]=np.array(mpl.colors.to_rgba(self.plot.get_color()))*255
+        if self.rasterImg is None :
+            self.rasterImg=AxesImage(self.axes, origin='lower',
+                                     interpolation='nearest', zorder=0.5)
+            self.axes.add_image(self.rasterImg)
+        self.rasterImg.set_data(rgba)
+        # The extent must not rescale the axes
+        (l, b), (r, t) = self.axes.transData.inverted().transform(
+                                        [(x0, y0), (x0+w, y0+h)])
+        auto=self.axes.get_autoscale_on()
+        self.axes.set_autoscale_on(False)
+        self.rasterImg.set_extent((l, r, b, t))
+        self.axes.set_autoscale_on(auto)
+
+    def onRaster(self, e):
+        '''Switch between the raster drawing and the plot markers'''
+        raster=self.menuRaster.IsChecked()
+        self.plot.set_visible(not raster)
+        if not raster and self.rasterImg is not None :
+            self.rasterImg.remove()
+            self.rasterImg=None
+        self.toolbar.draw()
+
     def redrawPlot(self):
-        self.axes.relim()
+        # The raster image covers the view, not the data.
+        # Leave it out or every autoscale zooms out a bit more.
+        if self.rasterImg is not None :
+            self.rasterImg.set_visible(False)
+        self.axes.relim(visible_only=True)
+        if self.rasterImg is not None :
+            self.rasterImg.set_visible(True)
+        if self.numPoints :
+            # The plot may hold only the points in the view
+            self.axes.update_datalim([(self.minX, self.minY),
+                                        (self.maxX, self.maxY)])
         self.axes.autoscale_view(True,True,True)
         self.set_markers()
         self.figure.canvas.draw()
@@ -754,12 +1304,29 @@ class CanvasFrame(wx.Frame):
         """ Open a file"""
         dlg = wx.FileDialog(self, "Choose a file", self.dirname, "", "*.*", wx.FD_OPEN)
         if dlg.ShowModal() == wx.ID_OK:
-            self.filename = dlg.GetFilename()
             self.dirname = dlg.GetDirectory()
-            self.datfn=os.path.join(self.dirname, self.filename)
+            fn=os.path.join(self.dirname, dlg.GetFilename())
             try :
-                self.dat=self.readData(self.datfn)
-                self.displayData(self.dat[1],self.dat[0])
+                cols=self.askColumns(fn)
+                if cols==[] :
+                    # Cancelled
+                    dlg.Destroy()
+                    return
+                dat=self.readData(fn, cols=cols,
+                            dtype=np.float32 if self.menuCompact.IsChecked() else float)
+                self.filename = dlg.GetFilename()
+                self.datfn=fn
+                self.dat=dat
+                self.setColumnChoices()
+                if self.menuWatch.IsChecked() :
+                    self.startTail()
+                else :
+                    self.getSample()
+                if self.dedupRemoved :
+                    wx.MessageBox('%d duplicated points were removed, %d left.'
+                                    % (self.dedupRemoved, self.numPoints),
+                                    'Duplicates merged')
+                self.displayData(self.dat[1],self.dat[0],self.cols)
                 w, h = self.maxX/20, self.maxY/20
                 self.updateROI(self.maxX/2, self.maxY/2,
                                self.maxX/20, self.maxY/20)
@@ -770,12 +1337,269 @@ class CanvasFrame(wx.Frame):
                 self.redrawPlot()
             except (IOError, IndexError, ValueError) as ex :
                 wx.MessageBox('The data from:\n\n'
-                              + self.datfn
+                              + fn
                               + '\n\ncould not be read properly.'
                               + '\nProbably the format is incorrect.',
                               'Error reading data')
         dlg.Destroy()
 
+    def askColumns(self, fn):
+        '''
+        Let the user pick the columns to load from files with
+        more columns than the X, Y and value. Returns None for
+        all columns and an empty list if cancelled.
+        '''
+        lbl=selengine.read_labels(fn)
+        if len(lbl)<=3 :
+            return None
+        dlg=wx.MultiChoiceDialog(self, 'Columns to load (X, Y, value, ...):',
+                                    'Select columns', lbl)
+        dlg.SetSelections([0,1,2])
+        cols=[]
+        while dlg.ShowModal() == wx.ID_OK :
+            cols=dlg.GetSelections()
+            if len(cols)>=3 :
+                break
+            wx.MessageBox('Select at least the X, Y and value columns.',
+                            'Too few columns!')
+            cols=[]
+        dlg.Destroy()
+        return cols
+
+    def setColumnChoices(self):
+        '''
+        Fill the column switches with the labels of the loaded data.
+        '''
+        lbl=self.dat[0] or []
+        names=[lbl[i] if i<len(lbl) and lbl[i].strip() else 'Column %d' % (i+1)
+                    for i in range(self.dat[1].shape[0])]
+        for ch, c in zip(self.colChoices, self.cols+[self.valCol]) :
+            ch.SetItems(names)
+            if c<len(names) :
+                ch.SetSelection(c)
+
+    def onColumnsChange(self, ev):
+        cols=[ch.GetSelection() for ch in self.colChoices]
+        if wx.NOT_FOUND in cols :
+            return
+        if cols[:2]!=self.cols :
+            if cols[0]==cols[1] :
+                wx.MessageBox('X and Y need to be different columns.',
+                                'Wrong columns!')
+                self.setColumnChoices()
+                return
+            # Bring back the original values of the old coordinates
+            # and shift the new ones to the origin.
+            d=self.dat[1]
+            for i, c in enumerate(self.cols) :
+                d[c]+=self.offset[i]
+                d[c]*=self.flip[i]
+            self.cols=cols[:2]
+            self.flip=[1,1]
+            self.offset=[0,0]
+            self._shift_to_origin()
+            self.displayData(self.dat[1],self.dat[0],self.cols)
+            self.axes.set_xlim(0,self.maxX)
+            self.axes.set_ylim(0,self.maxY)
+        self.valCol=cols[2]
+        self.toolbar.updateCanvas()
+
+    def onAddChannel(self, e):
+        '''Add the values from another file with the same points'''
+        if self.datfn=='' :
+            wx.MessageBox('Open a data file before adding channels to it.',
+                            'No data!')
+            return
+        if self.menuWatch.IsChecked() :
+            wx.MessageBox('Channels cannot be added to a watched file.',
+                            'Watching the file!')
+            return
+        dlg = wx.FileDialog(self, "Choose a channel file", self.dirname, "", "*.*", wx.FD_OPEN)
+        if dlg.ShowModal() == wx.ID_OK:
+            fn=os.path.join(dlg.GetDirectory(), dlg.GetFilename())
+            try :
+                self.addChannel(fn)
+            except (IOError, IndexError, ValueError) as ex :
+                wx.MessageBox('The channel from:\n\n' + fn
+                              + '\n\ncould not be added.\n' + str(ex),
+                              'Error reading data')
+        dlg.Destroy()
+
+    def addChannel(self, fn):
+        '''
+        Add the value columns of the fn file to the data.
+        The file must contain the same points in the same order.
+        '''
+        cols=self.askColumns(fn)
+        if cols==[] :
+            return
+        lbl, c = selengine.load_data(fn, cols=cols, dtype=self.dat[1].dtype)
+        # Put the channel in the frame of the loaded data
+        for i in (0,1) :
+            c[i]*=self.flip[i]
+            c[i]-=self.offset[i]
+        d=self.dat[1]
+        self.dat[1]=selengine.merge_channels(d, c, self.cols,
+                                    tol=1e-6*max(self.maxX, self.maxY))
+        name=os.path.splitext(os.path.basename(fn))[0]
+        self.dat[0]=(list(self.dat[0])+['']*(d.shape[0]-len(self.dat[0]))
+                        + ['%s: %s' % (name, l.strip()) for l in lbl[2:]])
+        self.channelFiles.append({'path': fn, 'cols': cols,
+                                  'fingerprint': selengine.fingerprint(fn)})
+        self.dataChanged()
+        self.plot.set_data(self.dat[1][self.cols[0]], self.dat[1][self.cols[1]])
+        self.setColumnChoices()
+        self.toolbar.updateCanvas()
+
+    def onSaveSession(self, e):
+        '''Save the session'''
+        if self.datfn=='' :
+            wx.MessageBox('Open a data file before saving the session.',
+                            'Nothing to save!')
+            return
+        dlg = wx.FileDialog(self, "Save session", self.dirname,
+                                os.path.splitext(self.filename)[0]+'.pss',
+                                "Session (*.pss)|*.pss|All files (*.*)|*.*",
+                                wx.FD_SAVE|wx.FD_OVERWRITE_PROMPT)
+        if dlg.ShowModal() == wx.ID_OK:
+            try :
+                self.saveSession(dlg.GetPath())
+            except (IOError, OSError) as ex :
+                wx.MessageBox('Cannot save the session:\n\n' + str(ex),
+                                'Error saving session')
+        dlg.Destroy()
+
+    def onOpenSession(self, e):
+        '''Restore a saved session'''
+        dlg = wx.DirDialog(self, "Choose a session (.pss)", self.dirname,
+                                wx.DD_DIR_MUST_EXIST)
+        if dlg.ShowModal() == wx.ID_OK:
+            try :
+                self.restoreSession(dlg.GetPath())
+            except (IOError, OSError, KeyError, ValueError) as ex :
+                wx.MessageBox('The session from:\n\n' + dlg.GetPath()
+                              + '\n\ncould not be restored.\n' + str(ex),
+                              'Error reading session')
+        dlg.Destroy()
+
+    def getZoomStack(self):
+        '''
+        Return the views (xmin, xmax, ymin, ymax) in the zoom stack
+        of the toolbar and the position of the current one.
+        '''
+        st=self.toolbar._nav_stack
+        return ([[float(v) for v in el[self.axes][0]] for el in st._elements],
+                st._pos)
+
+    def setZoomStack(self, views, pos):
+        self.toolbar.update()
+        for v in views :
+            self.axes.set_xlim(v[0], v[1])
+            self.axes.set_ylim(v[2], v[3])
+            self.toolbar.push_current()
+        if views :
+            self.toolbar._nav_stack._pos=pos
+            self.toolbar._update_view()
+
+    def saveSession(self, path):
+        '''
+        Save the references to the source files, the data, the derived
+        arrays and the state of the ROI and the view to the path directory.
+        '''
+        roi=self.toolbar.roi
+        views, pos = self.getZoomStack()
+        state={'datfn': self.datfn,
+               'fingerprint': self.datFingerprint,
+               'channels': self.channelFiles,
+               'labels': self.dat[0],
+               'readCols': self.readCols,
+               'dtype': np.dtype(self.readDtype).name,
+               'flip': self.flip,
+               'offset': [float(v) for v in self.offset],
+               'cols': self.cols,
+               'valCol': self.valCol,
+               'maxX': float(self.maxX),
+               'maxY': float(self.maxY),
+               'tailPos': self.tailPos,
+               'dedupParams': list(self.dedupParams),
+               'dedupRemoved': self.dedupRemoved,
+               'roi': None if roi is None else [float(roi.get_x()), float(roi.get_y()),
+                                                float(roi.get_width()), float(roi.get_height())],
+               'fixedSize': self.fixedSizeCB.IsChecked(),
+               'fixedNumber': self.fixedNumberCB.IsChecked(),
+               'numPts': self.numPtsCtrl.GetValue(),
+               'anchor': self.anchorRB.GetSelection(),
+               'aspect': self.aspectRB.GetSelection(),
+               'title': self.titleCtrl.GetValue(),
+               'zoom': views,
+               'zoomPos': pos,
+               }
+        arrays=dict(self.derived)
+        arrays['data']=self.dat[1]
+        selengine.save_session(path, state, arrays)
+
+    def restoreSession(self, path):
+        '''
+        Restore the session saved by saveSession. The data and the
+        derived arrays are memory-mapped, nothing is parsed again.
+        '''
+        state, arrays = selengine.load_session(path)
+        changed=[f['path'] for f in
+                    [{'path': state['datfn'], 'fingerprint': state['fingerprint']}]
+                        + state['channels']
+                    if not selengine.same_file(f['path'], f['fingerprint'])]
+        if changed :
+            wx.MessageBox('The source files:\n\n' + '\n'.join(changed)
+                          + '\n\nchanged or are missing since the session was saved.'
+                          + '\nThe data stored in the session is used.',
+                          'Changed source files')
+        if self.menuWatch.IsChecked() :
+            self.menuWatch.Check(False)
+            self.tailTimer.Stop()
+            self.tailBuf=None
+        self.datfn=state['datfn']
+        self.dirname, self.filename = os.path.split(self.datfn)
+        self.datFingerprint=state['fingerprint']
+        self.channelFiles=state['channels']
+        self.readCols=state['readCols']
+        self.readDtype=np.dtype(state['dtype']).type
+        self.tailPos=state['tailPos']
+        # Merged duplicates keep the data from being watched.
+        self.dedupParams=tuple(state.get('dedupParams', self.dedupParams))
+        self.dedupRemoved=state.get('dedupRemoved', 0)
+        self.flip=state['flip']
+        self.offset=state['offset']
+        self.cols=state['cols']
+        self.valCol=state['valCol']
+        self.dat=[state['labels'], arrays.pop('data')]
+        # Drop everything derived from the previous data
+        self.dataChanged()
+        self.derived=arrays
+        # The data is already shifted, do not touch the mapped pages.
+        self.minX=0
+        self.minY=0
+        self.maxX=state['maxX']
+        self.maxY=state['maxY']
+        self.numPoints=self.dat[1].shape[1]
+        self.setLimits()
+        self.setColumnChoices()
+        self.displayData(self.dat[1],self.dat[0],self.cols)
+
+        self.fixedSizeCB.SetValue(state['fixedSize'])
+        self.toolbar.fixedSize=state['fixedSize']
+        self.anchorRB.SetSelection(state['anchor'])
+        self.aspectRB.SetSelection(state['aspect'])
+        self.axes.set_aspect(self.aspectRB.GetString(state['aspect']),'datalim')
+        self.titleCtrl.SetValue(state['title'])
+        self.numPtsCtrl.SetValue(state['numPts'])
+        self.targetSelected=state['numPts']
+        self.fixedNumberCB.SetValue(state['fixedNumber'] and state['roi'] is not None)
+        self.numPtsCtrl.Enable(self.fixedNumberCB.IsChecked())
+        if state['roi'] is not None :
+            self.updateROI(*state['roi'])
+        self.setZoomStack(state['zoom'], state['zoomPos'])
+        self.toolbar.updateCanvas()
+
     def onPaint(self, event):
         self.canvas.draw()
 
@@ -796,6 +1620,249 @@ class CanvasFrame(wx.Frame):
             self.exportData(os.path.join(self.exdirname, filename))
         dlg.Destroy()
 
+    def onSizeMap(self, e):
+        '''Compute and show the size map for the fixed number of points'''
+        if not e.IsChecked() :
+            self.hideSizeMap()
+            self.canvas.draw()
+            return
+        if self.datfn=='' :
+            wx.MessageBox('Open a data file before computing the size map.',
+                            'No data!')
+            self.menuSizeMap.Check(False)
+            return
+        n=self.targetSelected or self.numSelected or 100
+        dlg=wx.TextEntryDialog(self, 'Number of points, grid columns and rows:',
+                                'Size map', '%d, 50, 50' % n)
+        try :
+            if dlg.ShowModal() != wx.ID_OK :
+                self.menuSizeMap.Check(False)
+                return
+            n, nx, ny = [int(v) for v in dlg.GetValue().split(',')]
+            if min(n, nx, ny)<1 :
+                raise ValueError
+        except ValueError :
+            wx.MessageBox('Give three positive integers separated by commas.',
+                            'Wrong size map parameters!')
+            self.menuSizeMap.Check(False)
+            return
+        finally :
+            dlg.Destroy()
+        with wx.BusyCursor() :
+            self.computeSizeMap(n, nx, ny)
+        self.showSizeMap()
+
+    def computeSizeMap(self, n, nx, ny):
+        if self.kdTree is None :
+            self.kdTree=selengine.kd_tree(self.dat[1], self.cols)
+        self.sizeMap=(n,)+selengine.size_map(self.kdTree, n, nx, ny,
+                            (self.minX, self.maxX, self.minY, self.maxY))
+
+    def showSizeMap(self):
+        '''
+        Show the size map as a semi-transparent image under the points.
+        '''
+        self.hideSizeMap()
+        n, x, y, w, cnt = self.sizeMap
+        xl, yl = self.axes.get_xlim(), self.axes.get_ylim()
+        self.sizeImg=self.axes.imshow(w, origin='lower', alpha=0.6, zorder=1,
+                            extent=(self.minX, self.maxX, self.minY, self.maxY),
+                            aspect=self.axes.get_aspect(), interpolation='nearest')
+        self.axes.set_xlim(xl)
+        self.axes.set_ylim(yl)
+        self.menuSizeMap.Check(True)
+        self.statbar.SetStatusText('Width for %d points: %.2f - %.2f'
+                                    % (n, np.nanmin(w), np.nanmax(w)), 0)
+        self.canvas.draw()
+
+    def hideSizeMap(self):
+        if self.sizeImg is not None :
+            self.sizeImg.remove()
+            self.sizeImg=None
+            self.menuSizeMap.Check(False)
+
+    def onExportSizeMap(self, e):
+        '''Export the size map as CSV'''
+        if self.sizeMap is None :
+            wx.MessageBox('Compute the size map before exporting it.',
+                            'Nothing to export!')
+            return
+        if self.exdirname is None :
+            self.exdirname = self.dirname
+        dlg = wx.FileDialog(self, "Choose a file", self.exdirname, "*.csv",
+                                "CSV file (*.csv)|*.csv|"+
+                                "All files (*.*)|*.*",
+                                wx.FD_SAVE|wx.FD_OVERWRITE_PROMPT)
+        if dlg.ShowModal() == wx.ID_OK:
+            self.exdirname = dlg.GetDirectory()
+            selengine.write_size_map(dlg.GetPath(), *self.sizeMap[1:])
+        dlg.Destroy()
+
+    def onExportTiles(self, e):
+        '''Export the data cut into the tiles of the given size'''
+        if self.datfn=='' :
+            wx.MessageBox('Open a data file before exporting tiles.',
+                            'Nothing to export!')
+            return
+        if self.toolbar.roi is not None :
+            w, h = self.toolbar.roi.get_width(), self.toolbar.roi.get_height()
+        else :
+            w, h = self.maxX/10, self.maxY/10
+        dlg=wx.TextEntryDialog(self, 'Width and height of the tiles (um):',
+                                'Export tiles', '%g, %g' % (w, h))
+        try :
+            if dlg.ShowModal() != wx.ID_OK :
+                return
+            w, h = [float(v) for v in dlg.GetValue().split(',')]
+            if w<=0 or h<=0 :
+                raise ValueError
+        except ValueError :
+            wx.MessageBox('Give two positive numbers separated by a comma.',
+                            'Wrong tile size!')
+            return
+        finally :
+            dlg.Destroy()
+        if self.exdirname is None :
+            self.exdirname = self.dirname
+        dlg=wx.DirDialog(self, "Choose the directory for the tiles", self.exdirname)
+        if dlg.ShowModal() == wx.ID_OK:
+            self.exdirname = dlg.GetPath()
+            prefix=os.path.splitext(self.filename)[0]
+            try :
+                with wx.BusyCursor() :
+                    tiles=selengine.export_tiles(self.dat[1], self.dat[0], w, h,
+                            self.exdirname, (self.minX, self.maxX, self.minY, self.maxY),
+                            self.valCol, self.sumColumns(), self.cols, prefix)
+            except (IOError, OSError, ValueError) as ex :
+                wx.MessageBox('Cannot export the tiles:\n\n' + str(ex),
+                                'Error exporting tiles')
+            else :
+                wx.MessageBox('%d tiles written to:\n\n%s' % (len(tiles), self.exdirname),
+                                'Tiles exported')
+        dlg.Destroy()
+
+    def onDedup(self, e):
+        '''Ask for the tolerance and the mode of merging duplicates'''
+        if not e.IsChecked() :
+            return
+        dlg=wx.TextEntryDialog(self, 'Tolerance (um) and the mode (%s):'
+                                % ', '.join(selengine.DEDUP_MODES),
+                                'Merge duplicates', '%g, %s' % self.dedupParams)
+        try :
+            if dlg.ShowModal() != wx.ID_OK :
+                self.menuDedup.Check(False)
+                return
+            tol, mode = [v.strip() for v in dlg.GetValue().split(',')]
+            tol=float(tol)
+            if tol<=0 or mode not in selengine.DEDUP_MODES :
+                raise ValueError
+        except ValueError :
+            wx.MessageBox('Give a positive tolerance and one of the modes: %s.'
+                            % ', '.join(selengine.DEDUP_MODES),
+                            'Wrong parameters!')
+            self.menuDedup.Check(False)
+            return
+        finally :
+            dlg.Destroy()
+        self.dedupParams=(tol, mode)
+
+    def onWatch(self, e):
+        '''Follow the rows appended to the data file'''
+        if not e.IsChecked() :
+            self.tailTimer.Stop()
+            self.tailBuf=None
+            return
+        if self.datfn=='' :
+            wx.MessageBox('Open a data file before watching it.',
+                            'Nothing to watch!')
+            self.menuWatch.Check(False)
+            return
+        if self.channelFiles :
+            wx.MessageBox('A file with added channels cannot be watched.',
+                            'Channels added!')
+            self.menuWatch.Check(False)
+            return
+        if self.dedupRemoved :
+            wx.MessageBox('The rows of the file do not match the data '
+                            'with merged duplicates. Open it again to watch it.',
+                            'Cannot watch!')
+            self.menuWatch.Check(False)
+            return
+        self.startTail()
+
+    def startTail(self):
+        self.tailBuf=ColumnBuffer(self.dat[1])
+        self.dat[1]=self.tailBuf.data
+        self.plot.set_data(self.dat[1][self.cols[0]], self.dat[1][self.cols[1]])
+        self.tailDirty=False
+        self.tailTimer.Start(500)
+
+    def onTailTimer(self, ev):
+        try :
+            d=self.readTail()
+        except (IOError, ValueError) as ex :
+            # Skip the unreadable part, keep watching.
+            print('Warning: Cannot read from', self.datfn, ex)
+            d=None
+        if d is not None :
+            self.appendRows(d)
+            self.tailDirty=True
+        # Cap the refresh rate of the plot
+        if self.tailDirty and time.time()-self.tailLastDraw > self.tailRedrawInterval :
+            self.tailDirty=False
+            self.tailLastDraw=time.time()
+            self.plot.set_data(self.dat[1][self.cols[0]], self.dat[1][self.cols[1]])
+            if self.fixedNumberCB.IsChecked() :
+                self.handleROIforN()
+            else :
+                self.toolbar.draw()
+
+    def appendRows(self, d):
+        '''
+        Add new rows (cols x rows array of raw values) to the data.
+        The limits and the ROI statistics are updated incrementally.
+        '''
+        cx, cy = self.cols
+        for i, c in enumerate(self.cols) :
+            d[c]*=self.flip[i]
+            d[c]-=self.offset[i]
+        self.tailBuf.append(d)
+        self.dat[1]=self.tailBuf.data
+        stats=self.roiStats
+        self.dataChanged()
+        mx, my = min(d[cx]), min(d[cy])
+        if mx<0 or my<0 :
+            # New points beyond the origin. Shift all the data
+            # and move the ROI together with it.
+            self._shift_to_origin()
+            if self.toolbar.roi :
+                x,y=self.toolbar.roi.get_xy()
+                self.toolbar.roi.set_xy((x-min(mx,0), y-min(my,0)))
+            self.toolbar.updateCanvas(redraw=False)
+            return
+        self.maxX=max(self.maxX, max(d[cx]))
+        self.maxY=max(self.maxY, max(d[cy]))
+        self.numPoints=self.tailBuf.n
+        self.setLimits()
+        if self.toolbar.roi is None :
+            return
+        l,r,b,t=self.getROIbox()
+        n, v = selengine.count_sum_box(d, l, r, b, t, self.sumColumns(), self.cols)
+        self.numSelected+=n
+        self.selSums+=v
+        self.conc=self.selSums[0]/((r-l)*(t-b))
+        if not self.fixedNumberCB.IsChecked() :
+            self.numPtsCtrl.SetValue(self.numSelected)
+        self.showNumber(self.numSelected)
+        self.showConc(self.conc)
+        self.showChannels(self.selSums/((r-l)*(t-b)))
+        if stats is not None and self.statsBox is not None :
+            # Values out of the histogram range go to the edge bins
+            selengine.update_stats(stats, d, None, self.statsBox,
+                                    self.statsCols, self.cols)
+            self.roiStats=stats
+            self.showStats()
+
     def onFixedSize(self, ev):
         if self.toolbar :
             self.toolbar.onFixedSize(ev)
@@ -850,25 +1917,43 @@ class CanvasFrame(wx.Frame):
     def _shift_to_origin(self, d=None):
         if d is None :
             d=self.dat[1]
-        d[0]-=min(d[0])
-        d[1]-=min(d[1])
+        mx, my = selengine.shift_to_origin(d, self.cols)
+        self.offset=[self.offset[0]+mx, self.offset[1]+my]
         self.minX=0
         self.minY=0
-        self.maxX=max(d[0])
-        self.maxY=max(d[1])
+        self.maxX=d[self.cols[0]].max()
+        self.maxY=d[self.cols[1]].max()
         self.numPoints = d.shape[1]
         self.setLimits()
+        self.dataChanged()
+
+    def dataChanged(self):
+        '''
+        Drop the structures derived from the data.
+        '''
+        self.derived.clear()
+        self.roiStats=None
+        self.kdTree=None
+        self.sizeMap=None
+        self.hideSizeMap()
+        self.viewCache=[]
 
     def onFlipX(self, ev):
-        self.dat[1][0]=-self.dat[1][0]
+        c=self.cols[0]
+        self.dat[1][c]=-self.dat[1][c]
+        self.flip[0]=-self.flip[0]
+        self.offset[0]=-self.offset[0]
         self._shift_to_origin()
-        self.plot.set_xdata(self.dat[1][0])
+        self.plot.set_xdata(self.dat[1][c])
         self.toolbar.updateCanvas()
 
     def onFlipY(self, ev):
-        self.dat[1][1]=-self.dat[1][1]
+        c=self.cols[1]
+        self.dat[1][c]=-self.dat[1][c]
+        self.flip[1]=-self.flip[1]
+        self.offset[1]=-self.offset[1]
         self._shift_to_origin()
-        self.plot.set_ydata(self.dat[1][1])
+        self.plot.set_ydata(self.dat[1][c])
         self.toolbar.updateCanvas()
 
     def onAspectChange(self, ev):
@@ -902,91 +1987,14 @@ class CanvasFrame(wx.Frame):
         as close as possible to target number of points (n).
         The function does not care about the GUI. Just the computation.
         '''
-
-        def optfunC(w, x, y, d):
-            hw=w/2
-            l=x-hw
-            b=y-hw
-            r=x+hw
-            t=y+hw
-            return n-np.count_nonzero((l<d[0]) & (d[0]<r) & (b<d[1]) & (d[1]<t))
-
-        def optfunLB(w, x, y, d):
-            l=x
-            b=y
-            r=x+w
-            t=y+w
-            return n-np.count_nonzero((l<d[0]) & (d[0]<r) & (b<d[1]) & (d[1]<t))
-
-        def optfunLT(w, x, y, d):
-            l=x
-            b=y-w
-            r=x+w
-            t=y
-            return n-np.count_nonzero((l<d[0]) & (d[0]<r) & (b<d[1]) & (d[1]<t))
-
-        def optfunRT(w, x, y, d):
-            l=x-w
-            b=y-w
-            r=x
-            t=y
-            return n-np.count_nonzero((l<d[0]) & (d[0]<r) & (b<d[1]) & (d[1]<t))
-
-        def optfunRB(w, x, y, d):
-            l=x-w
-            b=y
-            r=x
-            t=y+w
-            return n-np.count_nonzero((l<d[0]) & (d[0]<r) & (b<d[1]) & (d[1]<t))
-
-        optfun={'C': optfunC,
-                'LB': optfunLB,
-                'LT': optfunLT,
-                'RB': optfunRB,
-                'RT': optfunRT }
-
-        #print(fp)
-        d=self.dat[1]
-        minW=0
-        maxW=2*max(self.maxX-self.minX,self.maxY-self.minY)
-        if fp=='C' :
-            cx=x+w/2 ; cy=y+h/2
-        elif fp=='LB' :
-            cx=x ; cy=y
-        elif fp=='LT' :
-            cx=x ; cy=y+h
-        elif fp=='RT' :
-            cx=x+w ; cy=y+h
-        elif fp=='RB' :
-            cx=x+w ; cy=y
-        else :
-            print('This should not happen! Inform the author')
-
-        cx=min(cx,self.maxX)
-        cx=max(cx,self.minX)
-        cy=min(cy,self.maxY)
-        cy=max(cy,self.minY)
-
-        try :
-            nw=bisect(optfun[fp], minW, maxW, args=(cx,cy, d), xtol=10e-12)
-        except ValueError :
-            #wx.MessageBox('Cannot find a good solution for the selection box. ',
-            #                'Solver error!')
-            return x, y, math.sqrt(w*h)
-
-        if fp=='C' :
-            cx-=nw/2 ; cy-=nw/2
-        elif fp=='LB' :
-            pass
-        elif fp=='LT' :
-            cy-=nw
-        elif fp=='RT' :
-            cx-=nw ; cy-=nw
-        elif fp=='RB' :
-            cx-=nw
-        else :
-            print('This should not happen! Inform the author')
-        return cx, cy, nw
+        bounds=(self.minX, self.maxX, self.minY, self.maxY)
+        s=self.getSample()
+        if s is None :
+            return selengine.find_roi_for_n(self.dat[1], x, y, w, h, n, fp,
+                                            bounds, self.cols)
+        return selengine.find_roi_for_n_sampled(self.dat[1], s,
+                            s.shape[1]/self.dat[1].shape[1],
+                            x, y, w, h, n, fp, bounds, self.cols)
 
 class App(wx.App):
 
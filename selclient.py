@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 by Paweł T. Jochym <pawel.jochym@ifj.edu.pl>
+# This code is licensed under GPL v2 or later.
+# The oryginal repo is at: https://github.com/jochym/pointsel
+#
+'''
+Client of the point selector query server (selserver.py).
+
+    c=Client()
+    c.load('map.txt')
+    c.concentration('map.txt', [10, 10, 5, 5])
+
+Run as a script to measure the throughput of a running server:
+
+    python selclient.py map.txt --requests 2000 --concurrency 8
+'''
+
+from __future__ import division, print_function
+import json, time, random, threading
+import argparse
+
+try :
+    from http.client import HTTPConnection
+except ImportError :
+    from httplib import HTTPConnection
+
+
+class ServerError(Exception):
+    pass
+
+
+class Client(object):
+    '''
+    Connection to the server. Not thread safe - use one client per thread.
+    '''
+    def __init__(self, host='localhost', port=8765, timeout=60):
+        self.conn=HTTPConnection(host, port, timeout=timeout)
+
+    def call(self, op, **args):
+        self.conn.request('POST', '/'+op, json.dumps(args).encode('utf-8'),
+                            {'Content-Type': 'application/json'})
+        r=self.conn.getresponse()
+        res=json.loads(r.read().decode('utf-8'))
+        if r.status!=200 :
+            raise ServerError(res.get('error', r.reason))
+        return res
+
+    def close(self):
+        self.conn.close()
+
+    def load(self, path, name=None, cols=None, dtype='float64'):
+        return self.call('load', path=path, name=name, cols=cols, dtype=dtype)
+
+    def datasets(self):
+        return self.call('datasets')['datasets']
+
+    def info(self, dataset):
+        return self.call('info', dataset=dataset)
+
+    def count(self, dataset, roi):
+        return self.call('count', dataset=dataset, roi=roi)['count']
+
+    def concentration(self, dataset, roi):
+        r=self.call('concentration', dataset=dataset, roi=roi)
+        return r['count'], r['concentration']
+
+    def channels(self, dataset, roi):
+        r=self.call('channels', dataset=dataset, roi=roi)
+        return r['count'], r['concentrations']
+
+    def add_channel(self, dataset, path, cols=None):
+        return self.call('add_channel', dataset=dataset, path=path, cols=cols)
+
+    def select(self, dataset, roi):
+        return self.call('select', dataset=dataset, roi=roi)['points']
+
+    def find_roi_for_n(self, dataset, roi, n, anchor='C'):
+        return self.call('find_roi_for_n', dataset=dataset, roi=roi,
+                            n=n, anchor=anchor)['roi']
+
+    def export(self, dataset, roi, path):
+        return self.call('export', dataset=dataset, roi=roi, path=path)
+
+
+def loadtest(dataset, op='concentration', requests=1000, concurrency=8,
+                host='localhost', port=8765, size=0.05):
+    '''
+    Send requests with random ROIs of the size fraction of the map
+    from concurrency threads. Returns the number of requests per second.
+    '''
+    c=Client(host, port)
+    l, r, b, t = c.info(dataset)['bounds']
+    c.close()
+    w, h = size*(r-l), size*(t-b)
+
+    def worker(n, seed):
+        rnd=random.Random(seed)
+        c=Client(host, port)
+        for i in range(n) :
+            roi=[rnd.uniform(l, r-w), rnd.uniform(b, t-h), w, h]
+            if op=='find_roi_for_n' :
+                c.find_roi_for_n(dataset, roi, 100)
+            else :
+                c.call(op, dataset=dataset, roi=roi)
+        c.close()
+
+    threads=[threading.Thread(target=worker, args=(requests//concurrency, i))
+                for i in range(concurrency)]
+    start=time.time()
+    for th in threads :
+        th.start()
+    for th in threads :
+        th.join()
+    return concurrency*(requests//concurrency)/(time.time()-start)
+
+
+if __name__ == '__main__':
+    ap=argparse.ArgumentParser(description='Load test of the query server')
+    ap.add_argument('dataset', help='name of a dataset loaded in the server')
+    ap.add_argument('--op', default='concentration',
+                    choices=['count', 'concentration', 'select', 'find_roi_for_n'])
+    ap.add_argument('--requests', type=int, default=1000)
+    ap.add_argument('--concurrency', type=int, default=8)
+    ap.add_argument('--port', type=int, default=8765)
+    args=ap.parse_args()
+    rps=loadtest(args.dataset, args.op, args.requests, args.concurrency,
+                    port=args.port)
+    print('%s: %.1f requests/s with %d clients' % (args.op, rps, args.concurrency))
@@ -0,0 +1,1050 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 by Paweł T. Jochym <pawel.jochym@ifj.edu.pl>
+# This code is licensed under GPL v2 or later.
+# The oryginal repo is at: https://github.com/jochym/pointsel
+#
+'''
+Selection engine of the point selector.
+The GUI-independent part: reading, selecting and exporting the data.
+The data array has the layout used by the GUI: columns x points,
+with the x, y coordinates in columns 0, 1 and the value in column 2.
+'''
+
+from __future__ import division, print_function
+from numpy import array
+import numpy as np
+from scipy.optimize import bisect
+from scipy.spatial import cKDTree
+import os, math, locale, time, json, hashlib
+import argparse
+
+
+def parse_lines(lines, cols=None, dtype=float):
+    '''
+    Translate data lines into an array of cols x rows.
+    Comment (#) and empty lines are skipped.
+    The lines are split on '\n' only, other line breaks
+    (like '\r') are just white space.
+    Only the columns listed in cols (default: all) are converted
+    and stored, in the order given, as the dtype numbers.
+    '''
+    # The translation replaces ; and , by space and dot.
+    rows=(ln.replace(';',' ').replace(',','.').split()
+            for ln in lines if ln[:1]!='#' and ln.split())
+    if cols is not None :
+        rows=([r[i] for i in cols] for r in rows)
+    # Keep every column contiguous for the selection kernel.
+    return np.ascontiguousarray(array([[float(v) for v in r] for r in rows],
+                                        dtype=dtype).T)
+
+
+def read_labels(fn):
+    '''
+    Return the list of column labels from the first line of the fn file.
+    '''
+    with open(fn, newline='\n') as f :
+        return f.readline().replace('#','').strip().split(';')
+
+
+def read_data(fn, skip=1, cols=None, dtype=float):
+    '''
+    Read the data file named fn. Returns the [labels, data] list
+    in the format of CanvasFrame.readData. The data is not shifted.
+    See parse_lines for the cols and dtype parameters.
+    '''
+    with open(fn, newline='\n') as f :
+        df=f.readlines()
+    if skip>0 :
+        lbl=df[0].replace('#','').strip().split(';')
+        if cols is not None :
+            lbl=[lbl[i] if i<len(lbl) else '' for i in cols]
+    else :
+        lbl=None
+    return [lbl, parse_lines(df[skip:], cols, dtype)]
+
+
+# Files smaller than this are parsed serially.
+PARALLEL_MIN=32<<20
+
+
+def _line_after(f, p):
+    '''
+    Return the offset of the first line starting at or after p.
+    '''
+    if p==0 :
+        return 0
+    f.seek(p-1)
+    f.readline()
+    return f.tell()
+
+
+def _count_lines(fn, start, end):
+    '''
+    Count the lines in the start:end byte range of the fn file.
+    '''
+    n=0
+    last=b'\n'
+    with open(fn, 'rb') as f :
+        f.seek(start)
+        left=end-start
+        while left>0 :
+            buf=f.read(min(left, 1<<24))
+            if not buf :
+                break
+            n+=buf.count(b'\n')
+            left-=len(buf)
+            last=buf[-1:]
+    if end>start and last!=b'\n' :
+        n+=1
+    return n
+
+
+def _parse_range(fn, start, end, cols, dtype, shm_name, shape, off):
+    '''
+    Parse the start:end byte range of the fn file and write the rows
+    into the shared memory array at column off. Returns the nr. of rows.
+    '''
+    from multiprocessing import shared_memory
+    with open(fn, 'rb') as f :
+        f.seek(start)
+        lines=f.read(end-start).decode(locale.getpreferredencoding(False)).split('\n')
+    d=parse_lines(lines, cols, dtype)
+    if d.size==0 :
+        return 0
+    if d.shape[0]!=shape[0] :
+        raise ValueError('Expected %d columns, got %d' % (shape[0], d.shape[0]))
+    shm=shared_memory.SharedMemory(name=shm_name)
+    try :
+        out=np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        out[:,off:off+d.shape[1]]=d
+        del out
+    finally :
+        shm.close()
+    return d.shape[1]
+
+
+def last_line(fn, end):
+    '''
+    Return the offset and the text of the unterminated last line
+    in the first end bytes of the fn file. The text is empty if the
+    data ends with a newline.
+    '''
+    tail=b''
+    with open(fn, 'rb') as f :
+        p=end
+        while p>0 and b'\n' not in tail :
+            k=min(p, 1<<16)
+            p-=k
+            f.seek(p)
+            tail=f.read(k)+tail
+    i=tail.rfind(b'\n')+1
+    return end-len(tail)+i, tail[i:].decode(locale.getpreferredencoding(False))
+
+
+def read_data_parallel(fn, skip=1, cols=None, dtype=float, workers=None, end=None):
+    '''
+    Parallel version of read_data for large files. The data part
+    of the file (up to the end offset, default: its size) is split
+    at line boundaries into byte ranges parsed in a process pool.
+    The rows are written directly into a shared memory array.
+    The result is identical to read_data.
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import shared_memory
+
+    if end is None :
+        end=os.path.getsize(fn)
+    workers=workers or os.cpu_count()
+    dtype=np.dtype(dtype)
+    with open(fn, 'rb') as f :
+        enc=locale.getpreferredencoding(False)
+        lbl=None
+        for i in range(skip) :
+            ln=f.readline().decode(enc)
+            if i==0 :
+                lbl=ln.replace('#','').strip().split(';')
+                if cols is not None :
+                    lbl=[lbl[i] if i<len(lbl) else '' for i in cols]
+        body=f.tell()
+        # The number of columns from the first data line
+        ncols=None
+        while f.tell()<end :
+            ln=f.readline().decode(enc)
+            if ln[:1]!='#' and ln.split() :
+                ncols=len(cols) if cols is not None else len(parse_lines([ln]))
+                break
+        if ncols is None :
+            return [lbl, parse_lines([], cols, dtype)]
+        n=max(1, min(4*workers, (end-body)>>20))
+        bounds=sorted(set([body]+[min(_line_after(f, body+(end-body)*k//n), end)
+                                    for k in range(1, n)]+[end]))
+    ranges=list(zip(bounds[:-1], bounds[1:]))
+    if os.name=='posix' :
+        # The workers must share the resource tracker of this process,
+        # otherwise they report the shared memory as leaked on exit.
+        from multiprocessing import resource_tracker
+        resource_tracker.ensure_running()
+    with ProcessPoolExecutor(workers) as pool :
+        # Line counts give the upper bounds of the nr. of rows
+        cnt=list(pool.map(_count_lines, *zip(*[(fn, s, e) for s, e in ranges])))
+        offs=np.concatenate(([0], np.cumsum(cnt)))
+        shape=(ncols, max(1, int(offs[-1])))
+        shm=shared_memory.SharedMemory(create=True, size=shape[0]*shape[1]*dtype.itemsize)
+        try :
+            rows=list(pool.map(_parse_range,
+                        *zip(*[(fn, s, e, cols, dtype, shm.name, shape, int(o))
+                                for (s, e), o in zip(ranges, offs)])))
+            buf=np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            d=np.empty((ncols, sum(rows)), dtype=dtype)
+            p=0
+            for o, k in zip(offs, rows) :
+                d[:,p:p+k]=buf[:,o:o+k]
+                p+=k
+            del buf
+        finally :
+            shm.close()
+            shm.unlink()
+    return [lbl, d]
+
+
+def load_data(fn, skip=1, cols=None, dtype=float):
+    '''
+    Read the fn file with read_data, or with read_data_parallel
+    if the file is large.
+    '''
+    if os.path.getsize(fn)>=PARALLEL_MIN :
+        return read_data_parallel(fn, skip, cols, dtype)
+    return read_data(fn, skip, cols, dtype)
+
+
+DEDUP_MODES=('mean', 'first', 'last', 'drop')
+
+
+def dedup(d, tol, mode='mean', xy=(0,1), block=1<<22):
+    '''
+    Find the points of d with both coordinates in the same tol x tol
+    cell of the grid starting at the lowest coordinates and merge them
+    into one point with the mean values ('mean'), keep the 'first'
+    or the 'last' of them in the data order, or 'drop' them all.
+    The remaining points keep their order. The merged values are
+    written into d. Besides the result it takes about 24 bytes
+    per point, whatever the number of columns.
+    Returns the new data array and the number of removed points.
+    '''
+    if mode not in DEDUP_MODES :
+        raise ValueError('Unknown duplicates mode: %s' % mode)
+    n=d.shape[1]
+    if n<2 :
+        return d, 0
+    x, y = d[xy[0]], d[xy[1]]
+    x0, y0 = x.min(), y.min()
+    nx=int((x.max()-x0)//tol)+1
+    ny=int((y.max()-y0)//tol)+1
+    if nx*ny>=2**62 :
+        raise ValueError('The tolerance is too small for the range of the data')
+    # The cell number of every point, computed in blocks to keep the
+    # temporary arrays small. If possible the point index is packed
+    # into the low bits, so a plain sort orders the points by cell
+    # and by index, which is much faster than a stable argsort.
+    bits=(n-1).bit_length()
+    packed=nx*ny<2**(63-bits)
+    key=np.empty(n, dtype=np.int64)
+    for s in range(0, n, block) :
+        k=key[s:s+block]
+        np.floor_divide(x[s:s+block]-x0, tol, out=k, casting='unsafe')
+        k*=ny
+        k+=((y[s:s+block]-y0)//tol).astype(np.int64)
+        if packed :
+            k<<=bits
+            k|=np.arange(s, s+len(k))
+    if packed :
+        key.sort()
+        order=key&((1<<bits)-1)
+        key>>=bits
+    else :
+        order=np.argsort(key, kind='stable')
+        key=key[order]
+    first=np.empty(n, dtype=bool)
+    first[0]=True
+    np.not_equal(key[1:], key[:-1], out=first[1:])
+    del key
+    starts=np.flatnonzero(first)
+    del first
+    if len(starts)==n :
+        return d, 0
+    sizes=np.diff(np.append(starts, n))
+    keep=np.zeros(n, dtype=bool)
+    if mode=='last' :
+        keep[order[starts+sizes-1]]=True
+    elif mode=='drop' :
+        keep[order[starts[sizes==1]]]=True
+    else :
+        keep[order[starts]]=True
+    if mode=='mean' :
+        multi=sizes>1
+        pos=order[starts[multi]]
+        for c in range(d.shape[0]) :
+            v=np.add.reduceat(d[c][order], starts, dtype=float)
+            d[c][pos]=v[multi]/sizes[multi]
+    return d[:,keep], n-np.count_nonzero(keep)
+
+
+def shift_to_origin(d, xy=(0,1)):
+    '''
+    Shift the xy coordinate columns in place to start at zero.
+    Returns the shift (mx, my) subtracted from the columns.
+    '''
+    mx, my = d[xy[0]].min(), d[xy[1]].min()
+    d[xy[0]]-=mx
+    d[xy[1]]-=my
+    return mx, my
+
+
+# Number of points processed at once by the selection kernel.
+# The scratch masks of this size stay in the CPU cache.
+BLOCK=1<<16
+
+
+def _box_mask(x, y, box, m, tmp):
+    '''
+    Fill the m mask with the points of x, y inside the open l,r,b,t box.
+    The y range is tested only if some points are in the x range.
+    Returns False if there are no points in the box.
+    '''
+    l, r, b, t = box
+    np.less(l, x, out=m)
+    np.less(x, r, out=tmp)
+    m&=tmp
+    if not m.any() :
+        return False
+    np.less(b, y, out=tmp)
+    m&=tmp
+    np.less(y, t, out=tmp)
+    m&=tmp
+    return True
+
+
+def box_blocks(x, y, l, r, b, t, block=BLOCK):
+    '''
+    Scan the x, y coordinates in blocks and yield (start, mask)
+    for every block with some points inside the open l,r,b,t box.
+    The mask is a scratch buffer reused for the next block.
+    The y range is tested only in blocks with hits in the x range.
+    '''
+    n=len(x)
+    m=np.empty(min(block, n), dtype=bool)
+    tmp=np.empty_like(m)
+    for s in range(0, n, block) :
+        e=min(s+block, n)
+        mk=m[:e-s]
+        if _box_mask(x[s:e], y[s:e], (l, r, b, t), mk, tmp[:e-s]) :
+            yield s, mk
+
+
+def select_box(d, l, r, b, t, xy=(0,1)):
+    '''
+    Return an array of points inside the open l,r,b,t box.
+    The xy are the coordinate columns of d.
+    '''
+    idx=[np.flatnonzero(mk)+s
+            for s, mk in box_blocks(d[xy[0]], d[xy[1]], l, r, b, t)]
+    if not idx :
+        return d[...,:0]
+    return d[...,np.concatenate(idx)]
+
+
+def count_box(d, l, r, b, t, xy=(0,1)):
+    '''
+    Return the number of points inside the open l,r,b,t box.
+    '''
+    return sum(np.count_nonzero(mk)
+                    for s, mk in box_blocks(d[xy[0]], d[xy[1]], l, r, b, t))
+
+
+def count_sum_box(d, l, r, b, t, col=2, xy=(0,1)):
+    '''
+    Return the number of points inside the open l,r,b,t box
+    and the sum of their values in the col column.
+    If col is a list of columns, an array of sums is returned.
+    The selected points are never materialized.
+    '''
+    cols=np.atleast_1d(col)
+    n=0
+    v=np.zeros(len(cols))
+    for s, mk in box_blocks(d[xy[0]], d[xy[1]], l, r, b, t) :
+        n+=np.count_nonzero(mk)
+        v+=np.dot(d[cols,s:s+len(mk)], mk)
+    return n, (v if np.ndim(col) else v[0])
+
+
+def decimate(d, bounds, xy=(0,1), levels=range(6, 13)):
+    '''
+    Build the multi-resolution decimation of the d data for drawing.
+    At level k the minX, maxX, minY, maxY bounds are split into
+    2**k x 2**k cells and the first point of every non-empty cell
+    is kept. Returns a dict of the index arrays of the levels and of
+    all points ('all'), each sorted by x for cull_index. The levels
+    keeping more than half of the points are skipped.
+    '''
+    x, y = d[xy[0]], d[xy[1]]
+    n=len(x)
+    minX, maxX, minY, maxY = bounds
+    itype=np.int32 if n<2**31 else np.int64
+    res={'all': np.argsort(x).astype(itype)}
+    # Finer levels than about one point per cell are never useful.
+    levels=sorted(levels, reverse=True)
+    top=min(levels[0], max(levels[-1], n.bit_length()//2))
+    s=1<<top
+    ix=np.clip((x-minX)*(s/((maxX-minX) or 1)), 0, s-1).astype(itype)
+    iy=np.clip((y-minY)*(s/((maxY-minY) or 1)), 0, s-1).astype(itype)
+    idx=np.arange(n, dtype=itype)
+    for k in levels :
+        if k>top :
+            continue
+        # The first point of a cell is the first of the first points
+        # of its sub-cells, so every level is made from the finer one.
+        sh=top-k
+        c=((ix[idx]>>sh)<<k) | (iy[idx]>>sh)
+        first=np.full(1<<(2*k), len(idx), dtype=itype)
+        np.minimum.at(first, c, np.arange(len(idx), dtype=itype))
+        idx=idx[np.sort(first[first<len(idx)])]
+        if len(idx)<=n//2 :
+            res[k]=idx[np.argsort(x[idx])]
+    return res
+
+
+def cull_index(x, y, order, l, r, b, t):
+    '''
+    Return the indices from order (sorted by x) of the points inside
+    the l,r,b,t box. Only the points in the x range are scanned.
+    '''
+    lo, hi = np.searchsorted(x, (l, r), sorter=order)
+    s=order[lo:hi]
+    yy=y[s]
+    return s[(b<yy) & (yy<t)]
+
+
+def _raster_counts(x, y, m, w, h, block):
+    cnt=np.zeros(w*h, dtype=np.intp)
+    for s in range(0, len(x), block) :
+        xs, ys = x[s:s+block], y[s:s+block]
+        px=m[0,0]*xs+m[0,1]*ys+m[0,2]
+        py=m[1,0]*xs+m[1,1]*ys+m[1,2]
+        ok=(0<=px) & (px<w) & (0<=py) & (py<h)
+        i=py.astype(np.intp)
+        i*=w
+        i+=px.astype(np.intp)
+        cnt+=np.bincount(i[ok], minlength=w*h)
+    return cnt
+
+
+def rasterize(x, y, m, w, h, workers=None, block=1<<18):
+    '''
+    Count the points of x, y in the pixels of the w x h image.
+    The m affine transform (3x3 matrix) maps the data coordinates
+    to the pixels, with the origin at the lower left image corner.
+    Parts of the data are counted in workers threads (default:
+    nr. of cores), numpy releases the GIL.
+    Returns the (h, w) array of counts.
+    '''
+    n=len(x)
+    workers=min(workers or os.cpu_count(), max(1, n//block))
+    if workers==1 :
+        return _raster_counts(x, y, m, w, h, block).reshape(h, w)
+    from concurrent.futures import ThreadPoolExecutor
+    step=-(-n//workers)
+    with ThreadPoolExecutor(workers) as ex :
+        parts=list(ex.map(lambda s: _raster_counts(x[s:s+step], y[s:s+step],
+                                                    m, w, h, block),
+                            range(0, n, step)))
+    return sum(parts).reshape(h, w)
+
+
+def dilate(cnt, r):
+    '''
+    Spread the non-empty pixels of the cnt image over the disks
+    of radius r pixels (the footprint of a round marker), keeping
+    the maximum. Meant for images with few points.
+    '''
+    h, w = cnt.shape
+    iy, ix = np.nonzero(cnt)
+    v=cnt[iy, ix]
+    out=np.zeros_like(cnt)
+    ri=int(r)
+    for dy in range(-ri, ri+1) :
+        for dx in range(-ri, ri+1) :
+            if dx*dx+dy*dy<=r*r :
+                yy, xx = iy+dy, ix+dx
+                ok=(0<=yy) & (yy<h) & (0<=xx) & (xx<w)
+                np.maximum.at(out, (yy[ok], xx[ok]), v[ok])
+    return out
+
+
+def stratified_sample(d, bounds, size, xy=(0,1), cells=64, seed=None):
+    '''
+    Return the sorted indices of a stratified random sample of about
+    size points of the d data. The points are put in random order
+    within the cells of the cells x cells grid over the minX, maxX,
+    minY, maxY bounds and every k-th one is taken, so every cell
+    gets its proportional share of the sample.
+    '''
+    n=d.shape[1]
+    if size>=n :
+        return np.arange(n)
+    minX, maxX, minY, maxY = bounds
+    ix=np.clip((d[xy[0]]-minX)*(cells/((maxX-minX) or 1)), 0, cells-1).astype(np.int64)
+    iy=np.clip((d[xy[1]]-minY)*(cells/((maxY-minY) or 1)), 0, cells-1).astype(np.int64)
+    rnd=np.random.default_rng(seed)
+    key=((ix*cells+iy)<<32) + rnd.integers(0, 1<<32, n)
+    order=np.argsort(key)
+    k=n/size
+    return np.sort(order[(rnd.random()*k+np.arange(size)*k).astype(np.int64)])
+
+
+def estimate_box(s, frac, l, r, b, t, col=2, xy=(0,1), z=1.96):
+    '''
+    Estimate the number of points inside the open l,r,b,t box and
+    the sum of their values in the col column(s) like count_sum_box,
+    from the s sample taking the frac fraction of the points.
+    Returns the estimates and the half-widths of their confidence
+    intervals (z=1.96 gives 95%) from the variance of sampling
+    every point independently with the frac probability.
+    '''
+    sel=select_box(s, l, r, b, t, xy)
+    v=np.atleast_2d(sel[col].astype(float))
+    n=sel.shape[1]
+    k=1-frac
+    sums=v.sum(axis=1)/frac
+    dsums=z*np.sqrt(k*(v**2).sum(axis=1))/frac
+    if not np.ndim(col) :
+        sums, dsums = sums[0], dsums[0]
+    return n/frac, sums, z*math.sqrt(k*n)/frac, dsums
+
+
+def count_sum_boxes(d, boxes, col=2, xy=(0,1), chunk=1<<24):
+    '''
+    Return the numbers of points inside each of the open boxes
+    (l, r, b, t arrays) and the sums of their values in the col column,
+    like count_sum_box for many boxes at once. The points in the union
+    of the boxes are selected once and tested against groups of boxes
+    together, with at most chunk box-point pairs at a time.
+    '''
+    l, r, b, t = [np.asarray(a, dtype=float) for a in boxes]
+    s=select_box(d, l.min(), r.max(), b.min(), t.max(), xy)
+    x, y, v = s[xy[0]], s[xy[1]], s[col].astype(float)
+    k=len(l)
+    n=np.zeros(k, dtype=np.int64)
+    sums=np.zeros(k)
+    step=max(1, chunk//max(1, len(x)))
+    for i in range(0, k, step) :
+        j=slice(i, i+step)
+        m=((l[j,None]<x) & (x<r[j,None])) & ((b[j,None]<y) & (y<t[j,None]))
+        n[j]=np.count_nonzero(m, axis=1)
+        sums[j]=m.dot(v)
+    return n, sums
+
+
+def jitter_boxes(x, y, w, h, k, shift=0.1, resize=0.0, seed=0):
+    '''
+    Return the l, r, b, t arrays of k copies of the x,y,w,h ROI with
+    the centre moved at random by up to shift times the size and the
+    size scaled at random by 1-resize to 1+resize.
+    '''
+    rnd=np.random.default_rng(seed)
+    cx=x+w/2+rnd.uniform(-shift, shift, k)*w
+    cy=y+h/2+rnd.uniform(-shift, shift, k)*h
+    f=rnd.uniform(1-resize, 1+resize, k)/2
+    return cx-f*w, cx+f*w, cy-f*h, cy+f*h
+
+
+def jitter_concentration(d, x, y, w, h, k=200, shift=0.1, resize=0.0,
+                            col=2, xy=(0,1), seed=0):
+    '''
+    Return the concentrations in the col column of k jittered copies
+    of the x,y,w,h ROI (see jitter_boxes).
+    '''
+    l, r, b, t = jitter_boxes(x, y, w, h, k, shift, resize, seed)
+    n, v = count_sum_boxes(d, (l, r, b, t), col, xy)
+    return v/((r-l)*(t-b))
+
+
+def spread_summary(c):
+    '''
+    Return the number, mean, standard deviation and the 5, 50
+    and 95 percentiles of the c concentrations.
+    '''
+    return (len(c), c.mean(), c.std(ddof=1) if len(c)>1 else 0.0)+tuple(
+                np.percentile(c, [5, 50, 95]))
+
+
+def merge_channels(d, c, xy=(0,1), tol=0):
+    '''
+    Return the d data with the value columns of the c data appended.
+    The c data must have its coordinates in columns 0, 1 equal
+    (within tol) to the xy columns of d, point by point.
+    The coordinates are stored only once.
+    '''
+    if (c.shape[1]!=d.shape[1] or
+            not all(np.allclose(d[i], c[j], rtol=0, atol=tol)
+                        for i, j in zip(xy, (0,1)))) :
+        raise ValueError('The coordinates of the channel do not match the data')
+    return np.concatenate((d, c[2:].astype(d.dtype)))
+
+
+class StreamStats(object):
+    '''
+    Streaming statistics of several value columns: the number of points,
+    mean and variance (Welford/Chan updates) and fixed-bin histograms
+    over the lo:hi ranges, giving the approximate quantiles.
+    Points can be added and removed, in batches of columns x points.
+    '''
+    def __init__(self, lo, hi, bins=256):
+        self.lo=np.asarray(lo, dtype=float)
+        self.hi=np.asarray(hi, dtype=float)
+        self.bins=bins
+        self.n=0
+        self.mean=np.zeros(len(self.lo))
+        self.m2=np.zeros(len(self.lo))
+        self.hist=np.zeros((len(self.lo), bins), dtype=np.int64)
+
+    def _hist(self, v):
+        w=np.where(self.hi>self.lo, self.hi-self.lo, 1)
+        i=((v-self.lo[:,None])*(self.bins/w)[:,None]).astype(np.int64)
+        # Values beyond the range go to the edge bins
+        np.clip(i, 0, self.bins-1, out=i)
+        i+=(np.arange(len(self.lo))*self.bins)[:,None]
+        return np.bincount(i.ravel(), minlength=self.hist.size).reshape(self.hist.shape)
+
+    def add(self, v):
+        m=v.shape[1]
+        if m==0 :
+            return
+        mb=v.mean(axis=1)
+        m2b=((v-mb[:,None])**2).sum(axis=1)
+        n=self.n+m
+        delta=mb-self.mean
+        self.mean+=delta*m/n
+        self.m2+=m2b+delta**2*self.n*m/n
+        self.n=n
+        self.hist+=self._hist(v)
+
+    def remove(self, v):
+        m=v.shape[1]
+        if m==0 :
+            return
+        n=self.n-m
+        if n<=0 :
+            self.n=0
+            self.mean[:]=0
+            self.m2[:]=0
+            self.hist[:]=0
+            return
+        mb=v.mean(axis=1)
+        m2b=((v-mb[:,None])**2).sum(axis=1)
+        mean=(self.n*self.mean-m*mb)/n
+        delta=mb-mean
+        self.m2=np.maximum(self.m2-m2b-delta**2*n*m/self.n, 0)
+        self.mean=mean
+        self.n=n
+        self.hist-=self._hist(v)
+
+    def var(self):
+        return self.m2/(self.n-1) if self.n>1 else np.zeros_like(self.m2)
+
+    def edges(self, i):
+        return np.linspace(self.lo[i], self.hi[i], self.bins+1)
+
+    def quantiles(self, i, q):
+        '''
+        Approximate q quantiles of the i-th column from the histogram.
+        '''
+        if self.n==0 :
+            return np.zeros(len(q))
+        c=np.concatenate(([0], np.cumsum(self.hist[i])))
+        return np.interp(np.asarray(q)*self.n, c, self.edges(i))
+
+
+def update_stats(st, d, old, new, cols, xy=(0,1), block=BLOCK):
+    '''
+    Update the StreamStats st of the cols values of the points in the
+    old l,r,b,t box (None for empty) to the points in the new box.
+    Only the points entering and leaving the box are processed
+    and the selection is never materialized.
+    '''
+    x, y = d[xy[0]], d[xy[1]]
+    cols=np.asarray(cols)[:,None]
+    n=len(x)
+    mn=np.empty(min(block, n), dtype=bool)
+    mo=np.empty_like(mn)
+    tmp=np.empty_like(mn)
+    for s in range(0, n, block) :
+        e=min(s+block, n)
+        hn=_box_mask(x[s:e], y[s:e], new, mn[:e-s], tmp[:e-s])
+        ho=old is not None and _box_mask(x[s:e], y[s:e], old, mo[:e-s], tmp[:e-s])
+        if hn and ho :
+            enter=mn[:e-s] & ~mo[:e-s]
+            leave=mo[:e-s] & ~mn[:e-s]
+        elif hn :
+            enter, leave = mn[:e-s], None
+        elif ho :
+            enter, leave = None, mo[:e-s]
+        else :
+            continue
+        if enter is not None :
+            st.add(d[cols, np.flatnonzero(enter)+s])
+        if leave is not None :
+            st.remove(d[cols, np.flatnonzero(leave)+s])
+
+
+def box_for_anchor(w, x, y, fp):
+    '''
+    Return l,r,b,t of the square of width w anchored at x,y.
+    The fp anchor is one of C, LB, LT, RB, RT.
+    '''
+    if fp=='C' :
+        hw=w/2
+        return x-hw, x+hw, y-hw, y+hw
+    elif fp=='LB' :
+        return x, x+w, y, y+w
+    elif fp=='LT' :
+        return x, x+w, y-w, y
+    elif fp=='RT' :
+        return x-w, x, y-w, y
+    elif fp=='RB' :
+        return x-w, x, y, y+w
+    raise ValueError('Unknown anchor: %s' % fp)
+
+
+def anchor_point(x, y, w, h, fp):
+    '''
+    Return the anchor point of the x,y,w,h ROI.
+    '''
+    return {'C':  (x+w/2, y+h/2),
+            'LB': (x, y),
+            'LT': (x, y+h),
+            'RT': (x+w, y+h),
+            'RB': (x+w, y),
+            }[fp]
+
+
+def find_roi_for_n(d, x, y, w, h, n, fp='C', bounds=None, xy=(0,1),
+                    bracket=None):
+    '''
+    Find the squere ROI around the fp anchor of the x,y,w,h ROI
+    containing as close as possible to target number of points (n).
+    The bounds are minX, maxX, minY, maxY of the data.
+    The search starts in the lo, hi bracket of widths if given (it
+    is widened if needed) and counts only the points inside the
+    square of the hi width.
+    Returns x, y, w of the new square ROI.
+    '''
+    if bounds is None :
+        bounds=(min(d[xy[0]]), max(d[xy[0]]), min(d[xy[1]]), max(d[xy[1]]))
+    minX, maxX, minY, maxY = bounds
+
+    def optfun(w, x, y, d):
+        return n-count_box(d, *box_for_anchor(w, x, y, fp), xy=xy)
+
+    minW=0
+    maxW=2*max(maxX-minX,maxY-minY)
+    cx, cy = anchor_point(x, y, w, h, fp)
+    cx=min(cx,maxX)
+    cx=max(cx,minX)
+    cy=min(cy,maxY)
+    cy=max(cy,minY)
+
+    if bracket is not None :
+        lo, hi = bracket
+        hi=max(hi, 1e-9*maxW)
+        while True :
+            sub=select_box(d, *box_for_anchor(hi, cx, cy, fp), xy=xy)
+            if hi>=maxW or sub.shape[1]>=n :
+                break
+            hi=min(2*hi, maxW)
+        # All smaller squares at the anchor are inside this one
+        d=sub
+        while lo>0 and optfun(lo, cx, cy, d)<=0 :
+            lo/=2
+            if lo<1e-9*maxW :
+                lo=0
+        minW, maxW = lo, hi
+
+    try :
+        nw=bisect(optfun, minW, maxW, args=(cx,cy, d), xtol=10e-12)
+    except ValueError :
+        return x, y, math.sqrt(w*h)
+
+    l, r, b, t = box_for_anchor(nw, cx, cy, fp)
+    return l, b, nw
+
+
+def kd_tree(d, xy=(0,1)):
+    '''
+    Return the KD-tree of the xy coordinates of the d data.
+    '''
+    return cKDTree(np.column_stack((d[xy[0]], d[xy[1]])))
+
+
+def size_map(tree, n, nx, ny, bounds, workers=-1):
+    '''
+    Find the width of the centered (C anchor) square ROI containing
+    n points for every node of the nx by ny grid of cell centres
+    over the minX, maxX, minY, maxY bounds, like find_roi_for_n.
+    The square of width w holds the points closer than w/2 in the
+    max norm, so w is twice the distance to the n-th nearest neighbour
+    (the smallest such square; the bisection may stop anywhere below
+    the n+1-th neighbour).
+    Returns the x, y, width and count arrays of shape (ny, nx).
+    The count includes the points on the edge of the square (ties).
+    The width is nan where the data has less than n points.
+    '''
+    minX, maxX, minY, maxY = bounds
+    x=minX+(np.arange(nx)+0.5)*(maxX-minX)/nx
+    y=minY+(np.arange(ny)+0.5)*(maxY-minY)/ny
+    x, y = np.meshgrid(x, y)
+    c=np.column_stack((x.ravel(), y.ravel()))
+    r, i = tree.query(c, k=[n], p=np.inf, workers=workers)
+    r=r[:,0]
+    full=np.isfinite(r)
+    cnt=np.full(len(r), tree.n)
+    cnt[full]=tree.query_ball_point(c[full], r[full], p=np.inf,
+                                    workers=workers, return_length=True)
+    r[~full]=np.nan
+    return x, y, (2*r).reshape(x.shape), cnt.reshape(x.shape)
+
+
+def write_size_map(fn, x, y, w, cnt):
+    '''
+    Write the size map as CSV rows of centre x, y, width and count.
+    '''
+    np.savetxt(fn, np.column_stack((x.ravel(), y.ravel(), w.ravel(), cnt.ravel())),
+        fmt=('%.3f', '%.3f', '%.3f', '%d'), delimiter=',',
+        header='x,y,width,count', comments='')
+
+
+def find_roi_for_n_sampled(d, s, frac, x, y, w, h, n, fp='C', bounds=None,
+                            xy=(0,1)):
+    '''
+    Like find_roi_for_n, but solve it first on the s sample taking
+    the frac fraction of the points. The exact search is then done
+    in the bracket of three standard deviations of the sample width.
+    '''
+    m=n*frac
+    if m<10 :
+        return find_roi_for_n(d, x, y, w, h, n, fp, bounds, xy)
+    ws=find_roi_for_n(s, x, y, w, h, m, fp, bounds, xy)[2]
+    # The width goes as the square root of the count
+    e=1.5/math.sqrt(m)
+    return find_roi_for_n(d, x, y, w, h, n, fp, bounds, xy,
+                            bracket=(ws*max(0, 1-e), ws*(1+e)))
+
+
+def roi_header(lbl, sel, x, y, w, h, col=2, chans=None, spread=None):
+    '''
+    Return the export header for the selection sel of the x,y,w,h ROI.
+    The concentration is computed from the col column. If more
+    than one chans columns are given, their concentrations are
+    listed in an additional line. The spread summary of the
+    concentration over jittered ROIs (see spread_summary) gets
+    a line too.
+    '''
+    hdr=' ;'.join([' %s' % s.strip() for s in lbl])
+    if x is not None :
+        hdr += '\n'
+        hdr += (' ROI (um): X=%.2f  Y=%.2f  W=%.2f  H=%.2f    Points=%d   Concentration=%g'
+                    % (x, y, w,h, sel.shape[1],sum(sel[col])/(w*h)) )
+        if chans is not None and len(chans)>1 :
+            hdr += '\n Channels:'
+            hdr += ''.join(['  %s=%g' % (lbl[c].strip() if c<len(lbl) else c, sum(sel[c])/(w*h))
+                                for c in chans])
+        if spread is not None :
+            hdr += ('\n Jitter: Boxes=%d  Mean=%g  Std=%g  P5=%g  P50=%g  P95=%g'
+                        % tuple(spread))
+    return hdr
+
+
+def write_selection(fn, sel, hdr, xy=(0,1)):
+    '''
+    Write the selected points to the fn file shifted to the origin.
+    '''
+    d=array(sel, dtype=float)
+    # Shift exported data to the origin
+    if d.shape[1] :
+        shift_to_origin(d, xy)
+    np.savetxt(fn, d.T, fmt='%11.3f', delimiter=' ', newline='\n',
+        header=hdr, footer='', comments='#')
+
+
+def tile_index(d, w, h, bounds, xy=(0,1)):
+    '''
+    Assign the points of d to the tiles of width w and height h
+    covering the minX, maxX, minY, maxY bounds from the minX, minY
+    corner. The tiles are closed at the left and bottom, the points
+    at maxX or maxY belong to the last tiles. Returns the nx, ny
+    numbers of tiles, the point indices sorted by tile (row by row,
+    keeping the data order within a tile) and the start of every
+    tile in them (nx*ny+1 offsets).
+    '''
+    minX, maxX, minY, maxY = bounds
+    nx=max(1, int(math.ceil((maxX-minX)/w)))
+    ny=max(1, int(math.ceil((maxY-minY)/h)))
+    ix=np.clip(((d[xy[0]]-minX)//w).astype(np.int64), 0, nx-1)
+    iy=np.clip(((d[xy[1]]-minY)//h).astype(np.int64), 0, ny-1)
+    tile=iy*nx+ix
+    order=np.argsort(tile, kind='stable')
+    starts=np.concatenate(([0], np.cumsum(np.bincount(tile, minlength=nx*ny))))
+    return nx, ny, order, starts
+
+
+def export_tiles(d, lbl, w, h, outdir, bounds=None, col=2, chans=None,
+                    xy=(0,1), prefix='tile', skip_empty=False, workers=None):
+    '''
+    Cut the d data into the w x h tiles (see tile_index) and export
+    every tile like a selection of its ROI: with the roi_header and
+    shifted to the origin. The files are named prefix_X_Y.txt by the
+    column and row of the tile and written in a pool of workers
+    processes (default: nr. of cores, 1 writes them here).
+    Returns the list of (file name, points) of the written tiles.
+    '''
+    if bounds is None :
+        bounds=(d[xy[0]].min(), d[xy[0]].max(), d[xy[1]].min(), d[xy[1]].max())
+    nx, ny, order, starts = tile_index(d, w, h, bounds, xy)
+    if not os.path.isdir(outdir) :
+        os.makedirs(outdir)
+    jobs=[]
+    for k in range(nx*ny) :
+        s, e = starts[k], starts[k+1]
+        if skip_empty and s==e :
+            continue
+        j, i = divmod(k, nx)
+        sel=d[:,order[s:e]]
+        hdr=roi_header(lbl, sel, bounds[0]+i*w, bounds[2]+j*h, w, h, col, chans)
+        jobs.append((os.path.join(outdir, '%s_%d_%d.txt' % (prefix, i, j)), sel, hdr))
+    if workers==1 :
+        for fn, sel, hdr in jobs :
+            write_selection(fn, sel, hdr, xy)
+    else :
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(workers) as pool :
+            for f in [pool.submit(write_selection, fn, sel, hdr, xy)
+                        for fn, sel, hdr in jobs] :
+                f.result()
+    return [(fn, sel.shape[1]) for fn, sel, hdr in jobs]
+
+
+SESSION_VERSION=1
+
+
+def fingerprint(fn):
+    '''
+    Return the size, modification time and the hash of the first
+    and last MB of the fn file, to detect changed source files.
+    '''
+    st=os.stat(fn)
+    h=hashlib.sha1()
+    with open(fn, 'rb') as f :
+        h.update(f.read(1<<20))
+        if st.st_size>2<<20 :
+            f.seek(-(1<<20), 2)
+            h.update(f.read())
+    return {'size': st.st_size, 'mtime': st.st_mtime, 'sha1': h.hexdigest()}
+
+
+def same_file(fn, fp):
+    '''
+    Check if the fn file still matches the fp fingerprint.
+    '''
+    try :
+        new=fingerprint(fn)
+    except (IOError, OSError) :
+        return False
+    return new['size']==fp['size'] and new['sha1']==fp['sha1']
+
+
+def save_session(path, state, arrays):
+    '''
+    Save the session into the path directory: the state dict as
+    session.json and every member of the arrays dict as a .npy file.
+    Files are replaced atomically, so the arrays of a session restored
+    from the same directory stay valid while it is overwritten.
+    '''
+    if not os.path.isdir(path) :
+        os.makedirs(path)
+    for name, a in arrays.items() :
+        fn=os.path.join(path, name+'.npy')
+        with open(fn+'.tmp', 'wb') as f :
+            np.save(f, np.asarray(a))
+        os.replace(fn+'.tmp', fn)
+    state=dict(state, version=SESSION_VERSION, arrays=sorted(arrays))
+    fn=os.path.join(path, 'session.json')
+    with open(fn+'.tmp', 'w') as f :
+        json.dump(state, f, indent=1)
+    os.replace(fn+'.tmp', fn)
+    for fn in os.listdir(path) :
+        if fn.endswith('.npy') and fn[:-4] not in arrays :
+            os.remove(os.path.join(path, fn))
+
+
+def load_session(path):
+    '''
+    Load the session saved by save_session. Returns the state dict
+    and the dict of arrays memory-mapped copy-on-write from the files.
+    '''
+    with open(os.path.join(path, 'session.json')) as f :
+        state=json.load(f)
+    if state.get('version', 0)>SESSION_VERSION :
+        raise ValueError('Session saved by a newer version')
+    arrays=dict((name, np.load(os.path.join(path, name+'.npy'), mmap_mode='c'))
+                    for name in state['arrays'])
+    return state, arrays
+
+
+def bench_parse(fn, workers=None, dtype=float):
+    '''
+    Print the time of parsing the fn file serially and in parallel
+    with 1, 2, 4, ... workers (up to workers, default: nr. of cores).
+    '''
+    t=time.time()
+    ref=read_data(fn, dtype=dtype)[1]
+    ts=time.time()-t
+    print('serial      : %8.2f s' % ts)
+    n=1
+    while n<=(workers or os.cpu_count()) :
+        t=time.time()
+        d=read_data_parallel(fn, dtype=dtype, workers=n)[1]
+        tp=time.time()-t
+        print('%2d worker(s): %8.2f s  speedup %5.2f  %s'
+                % (n, tp, ts/tp, 'ok' if np.array_equal(d, ref) else 'DIFFERENT'))
+        n*=2
+
+
+if __name__ == '__main__':
+    ap=argparse.ArgumentParser(description='Point selector engine tools')
+    sub=ap.add_subparsers(dest='cmd')
+    p=sub.add_parser('bench-parse', help='scaling of the parallel parser')
+    p.add_argument('file')
+    p.add_argument('--workers', type=int, default=None)
+    p.add_argument('--float32', action='store_true')
+    p=sub.add_parser('export-tiles', help='export the data cut into tiles')
+    p.add_argument('file')
+    p.add_argument('width', type=float)
+    p.add_argument('height', type=float)
+    p.add_argument('outdir')
+    p.add_argument('--prefix', default='tile')
+    p.add_argument('--skip-empty', action='store_true')
+    p.add_argument('--workers', type=int, default=None)
+    args=ap.parse_args()
+    if args.cmd=='bench-parse' :
+        bench_parse(args.file, args.workers, np.float32 if args.float32 else float)
+    elif args.cmd=='export-tiles' :
+        lbl, d = load_data(args.file)
+        shift_to_origin(d)
+        tiles=export_tiles(d, lbl, args.width, args.height, args.outdir,
+                            chans=list(range(2, d.shape[0])), prefix=args.prefix,
+                            skip_empty=args.skip_empty, workers=args.workers)
+        print('%d tiles, %d points written to %s'
+                % (len(tiles), sum(n for fn, n in tiles), args.outdir))
+    else :
+        ap.print_help()
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 by Paweł T. Jochym <pawel.jochym@ifj.edu.pl>
+# This code is licensed under GPL v2 or later.
+# The oryginal repo is at: https://github.com/jochym/pointsel
+#
+'''
+Local query server for the point selector.
+
+Keeps the datasets loaded in memory and answers the selection
+requests of other tools over HTTP on localhost. Every request is
+a POST to /<operation> with a JSON (or msgpack, if installed)
+object of arguments. The ROI is given as [x, y, w, h] in the
+coordinates shifted to the origin, as shown by the GUI.
+
+    load            path, name, cols, dtype -> name, points, columns, bounds
+    datasets                                -> datasets
+    info            dataset                 -> points, columns, bounds
+    count           dataset, roi            -> count
+    concentration   dataset, roi            -> count, concentration
+    channels        dataset, roi            -> count, concentrations
+    add_channel     dataset, path, cols     -> points, columns, bounds
+    select          dataset, roi            -> points (list of columns)
+    find_roi_for_n  dataset, roi, n, anchor -> roi
+    export          dataset, roi, path      -> path, points
+
+The client side is in selclient.py.
+'''
+
+from __future__ import division, print_function
+import os, json, threading
+import argparse
+
+from concurrent.futures import ThreadPoolExecutor
+
+try :
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError :
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+try :
+    import msgpack
+except ImportError :
+    msgpack = None
+
+import numpy as np
+
+import selengine
+
+
+class Dataset(object):
+    '''
+    Data file loaded and shifted to the origin like in the GUI.
+    '''
+    def __init__(self, fn, cols=None, dtype=float):
+        self.fn=fn
+        self.lbl, self.dat = selengine.load_data(fn, cols=cols, dtype=dtype)
+        self.offset=selengine.shift_to_origin(self.dat)
+        self.bounds=(0, float(self.dat[0].max()), 0, float(self.dat[1].max()))
+
+    def info(self):
+        return {'points': int(self.dat.shape[1]),
+                'columns': self.lbl,
+                'bounds': self.bounds}
+
+    def select(self, roi):
+        x, y, w, h = roi
+        return selengine.select_box(self.dat, x, x+w, y, y+h)
+
+    def add_channel(self, fn, cols=None):
+        lbl, c = selengine.load_data(fn, cols=cols, dtype=self.dat.dtype)
+        c[0]-=self.offset[0]
+        c[1]-=self.offset[1]
+        n=self.dat.shape[0]
+        self.dat=selengine.merge_channels(self.dat, c,
+                                tol=1e-6*max(self.bounds[1], self.bounds[3]))
+        name=os.path.splitext(os.path.basename(fn))[0]
+        self.lbl=(list(self.lbl)+['']*(n-len(self.lbl))
+                    + ['%s: %s' % (name, l.strip()) for l in lbl[2:]])
+
+
+def _check_area(w, h):
+    '''
+    Concentrations need a ROI with a positive area.
+    '''
+    if not (w>0 and h>0) :
+        raise ValueError('The ROI must have a positive width and height')
+
+
+class SelectionService(object):
+    '''
+    The operations of the server. Each public method takes
+    the request arguments and returns a JSON-able dict.
+    '''
+    def __init__(self):
+        self.datasets={}
+        self.lock=threading.Lock()
+
+    def dataset(self, name):
+        try :
+            return self.datasets[name]
+        except KeyError :
+            raise LookupError('Unknown dataset: %s' % name)
+
+    def load(self, path, name=None, cols=None, dtype='float64'):
+        if name is None :
+            name=os.path.basename(path)
+        ds=Dataset(path, cols, np.dtype(dtype))
+        with self.lock :
+            self.datasets[name]=ds
+        r=ds.info()
+        r['name']=name
+        return r
+
+    def datasets_(self):
+        return {'datasets': sorted(self.datasets)}
+
+    def info(self, dataset):
+        return self.dataset(dataset).info()
+
+    def count(self, dataset, roi):
+        x, y, w, h = roi
+        d=self.dataset(dataset).dat
+        return {'count': int(selengine.count_box(d, x, x+w, y, y+h))}
+
+    def concentration(self, dataset, roi):
+        x, y, w, h = roi
+        _check_area(w, h)
+        d=self.dataset(dataset).dat
+        n, v = selengine.count_sum_box(d, x, x+w, y, y+h)
+        return {'count': int(n), 'concentration': float(v/(w*h))}
+
+    def channels(self, dataset, roi):
+        x, y, w, h = roi
+        _check_area(w, h)
+        ds=self.dataset(dataset)
+        cols=list(range(2, ds.dat.shape[0]))
+        n, v = selengine.count_sum_box(ds.dat, x, x+w, y, y+h, cols)
+        return {'count': int(n),
+                'concentrations': dict((ds.lbl[c].strip() if c<len(ds.lbl) else str(c),
+                                        float(s/(w*h))) for c, s in zip(cols, v))}
+
+    def add_channel(self, dataset, path, cols=None):
+        ds=self.dataset(dataset)
+        with self.lock :
+            ds.add_channel(path, cols)
+        return ds.info()
+
+    def select(self, dataset, roi):
+        return {'points': self.dataset(dataset).select(roi).tolist()}
+
+    def find_roi_for_n(self, dataset, roi, n, anchor='C'):
+        ds=self.dataset(dataset)
+        x, y, w = selengine.find_roi_for_n(ds.dat, *roi, n=n, fp=anchor,
+                                            bounds=ds.bounds)
+        return {'roi': [float(x), float(y), float(w), float(w)]}
+
+    def export(self, dataset, roi, path):
+        _check_area(*roi[2:])
+        ds=self.dataset(dataset)
+        sel=ds.select(roi)
+        selengine.write_selection(path, sel,
+                        selengine.roi_header(ds.lbl, sel, *roi,
+                                        chans=list(range(2, ds.dat.shape[0]))))
+        return {'path': path, 'points': int(sel.shape[1])}
+
+    def call(self, op, args):
+        if op=='datasets' :
+            op='datasets_'
+        if op.startswith('_') or op in ('call', 'dataset') or not hasattr(self, op) :
+            raise LookupError('Unknown operation: %s' % op)
+        return getattr(self, op)(**args)
+
+
+# Host names of the server accepted in the Host and Origin headers.
+# Other names mean a request forwarded from a web page (DNS rebinding).
+LOCAL_HOSTS=('localhost', '127.0.0.1', '[::1]')
+
+
+def _host_name(host):
+    '''
+    Return the host name of the host[:port] header value.
+    '''
+    if host.startswith('[') :
+        return host[:host.find(']')+1]
+    return host.split(':')[0]
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version='HTTP/1.1'
+    # Headers and body are written separately. Do not wait for ACKs.
+    disable_nagle_algorithm=True
+    # Close the keep-alive connections idle for this long (s).
+    timeout=60
+
+    def reply(self, code, res, packed=False):
+        if packed :
+            body=msgpack.packb(res)
+            ctype='application/msgpack'
+        else :
+            body=json.dumps(res).encode('utf-8')
+            ctype='application/json'
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def check_request(self):
+        '''
+        Return the error code and message if the request must be refused.
+        Web pages can POST simple (text/plain) requests to localhost
+        without asking first, so only the JSON and msgpack content types
+        are accepted and the Host and Origin must be this machine.
+        '''
+        ctype=self.headers.get('Content-Type', '').split(';')[0].strip()
+        if ctype not in ('application/json', 'application/msgpack') :
+            return 415, 'Unsupported content type: %s' % ctype
+        if _host_name(self.headers.get('Host', '')) not in LOCAL_HOSTS :
+            return 403, 'Forbidden host'
+        origin=self.headers.get('Origin')
+        if origin is not None and _host_name(origin.split('://')[-1]) not in LOCAL_HOSTS :
+            return 403, 'Forbidden origin'
+        return None
+
+    def do_POST(self):
+        packed = (msgpack is not None and
+                    self.headers.get('Content-Type')=='application/msgpack')
+        body=self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        err=self.check_request()
+        if err is not None :
+            self.reply(err[0], {'error': err[1]}, packed)
+            return
+        try :
+            if packed :
+                args=msgpack.unpackb(body) if body else {}
+            else :
+                args=json.loads(body.decode('utf-8')) if body else {}
+            res=self.server.call(self.path.strip('/'), args)
+        except LookupError as ex :
+            self.reply(404, {'error': str(ex)}, packed)
+        except (TypeError, ValueError, IndexError, IOError) as ex :
+            self.reply(400, {'error': str(ex)}, packed)
+        else :
+            self.reply(200, res, packed)
+
+    def log_message(self, format, *args):
+        if self.server.verbose :
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class SelectionServer(ThreadingMixIn, HTTPServer):
+    '''
+    HTTP server reading the requests of every connection in its own
+    (daemon) thread. The operations run in a bounded pool of worker
+    threads, so idle keep-alive connections do not hold the workers.
+    The heavy work is done by numpy, which releases the GIL.
+    '''
+    daemon_threads=True
+
+    def __init__(self, addr, service, workers=None, verbose=False):
+        self.service=service
+        self.verbose=verbose
+        self.pool=ThreadPoolExecutor(workers)
+        HTTPServer.__init__(self, addr, RequestHandler)
+
+    def call(self, op, args):
+        return self.pool.submit(self.service.call, op, args).result()
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.pool.shutdown(wait=False)
+
+
+def main(argv=None):
+    ap=argparse.ArgumentParser(description='Point selector query server')
+    ap.add_argument('files', nargs='*', help='data files to preload')
+    ap.add_argument('--port', type=int, default=8765)
+    ap.add_argument('--workers', type=int, default=None,
+                    help='number of worker threads running the requests '
+                         '(default: nr. of cores + 4, at most 32)')
+    ap.add_argument('--verbose', action='store_true')
+    args=ap.parse_args(argv)
+
+    service=SelectionService()
+    for fn in args.files :
+        r=service.load(fn)
+        print('Loaded %s: %d points' % (r['name'], r['points']))
+    srv=SelectionServer(('localhost', args.port), service,
+                        args.workers, args.verbose)
+    print('Serving on localhost:%d' % args.port)
+    try :
+        srv.serve_forever()
+    except KeyboardInterrupt :
+        pass
+    finally :
+        srv.server_close()
+
+
+if __name__ == '__main__':
+    main()